@@ -11,13 +11,16 @@ Processing of the data obtained with a slope bottom
 
 from __future__ import (absolute_import, division, print_function)
 import numpy as np
-from numpy.fft import rfftfreq, rfft
+from numpy.fft import rfftfreq
 import matplotlib.pyplot as plt
 #from scipy.special import hankel1
 import os.path
 import glob
+import multiprocessing
 import argparse # To deal with arguments :
 # https://docs.python.org/2/library/argparse.html
+from seismogram_tools import zero_pad # Shared seismogram tools (link to utils/seismogram_tools.py)
+from transmissionLosses import parseFrequencies, powerSpectra, interpolateSpectra, dftSpectra, stationAmplitudes, poolAmplitudes # Batched TL engine
 
 def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     """Filter the signal... Useless here..."""
@@ -115,19 +118,14 @@ def ReadStations(path):
     stats=np.loadtxt(path,usecols=(2,3))
     return stats[:,0],stats[:,1]
 
-def ReadSeismo(path):
-    data=np.loadtxt(path)
-    return data[:,0],data[:,1]
-
-def zeroPad(t,ft,nZeros):
-    """ From t and f(t) add points to t and zeros to f(t)
-    dt must be constant : t[1]-t[0]=t[2]-t[1]=...=t[n]-t[n-1]
-    """
-    dt=t[1]-t[0]
-    for i in np.arange(nZeros):
-        t=np.append(t,t[-1]+dt)
-        ft=np.append(ft,0.0)
-    return t,ft
+def cellEdges(centers):
+    """Return the edges of the cells around the (sorted) values centers: the midpoints between consecutive
+    values, extended by half a step at both ends (pcolormesh needs them to show every row and column)"""
+    centers = np.asarray(centers,dtype=float)
+    if len(centers) == 1:
+        return np.array([centers[0]-0.5,centers[0]+0.5])
+    midpoints = (centers[1:]+centers[:-1])/2.0
+    return np.concatenate(([centers[0]-(midpoints[0]-centers[0])],midpoints,[centers[-1]+(centers[-1]-midpoints[-1])]))
 
 DEBUG_PLOT=False
 
@@ -145,12 +143,21 @@ parser.add_argument('--pad', type=int, default = 1,
     help='How much we 0 pad (must be 1,2,4,8 ...) !! Costly !!')
 parser.add_argument('--freq', type=float, default = 1.0,
     help='The frequency at which we want to compute transmission losses')
+parser.add_argument('--freqs', type=str, default = None,
+    help='Several frequencies at which we want to compute transmission losses (replaces --freq): \
+          list f1,f2,f3,... or band fmin:fmax:step. Every spectrum is computed once for all frequencies \
+          and a matrix range x frequency is written')
+parser.add_argument('--exact', action='store_true',
+    help='Evaluate the spectra exactly at the frequencies given by a direct DFT \
+          (no zero padding, no interpolation between frequency bins: --pad is not used)')
+parser.add_argument('--workers', type=int, default = 1,
+    help='Number of local processes computing the spectra (0 uses all the cores). Default: 1')
 parser.add_argument('--outputPath',type=str, default = 'losses.txt',
     help='Path where we store the transmission Losses Files')
 parser.add_argument('--noplot', action='store_true',
     help='do not display any curves')
 parser.add_argument('--refAmpl', type=float, default = -1.0,
-    help='Reference amplitude at the frequency given')
+    help='Reference amplitude at the frequency given (the same for all frequencies with --freqs)')
 parser.add_argument('-v','--verbose', action='store_true',
     help='display more information')
 
@@ -160,6 +167,10 @@ args = parser.parse_args()
 NdownSampled=args.NdownSampled # Downsampling
 pad=args.pad # How much we 0 pad (must be 1,2,4,8 ...) !! Costly !!
 freq=args.freq # The frequency at which we want to compute transmission losses
+if args.freqs is not None:
+    freqs=parseFrequencies(args.freqs) # Frequencies at which we want to compute transmission losses
+else:
+    freqs=np.array([freq])
 
 ##################### READ FILES #####################
 # Directory where the Specfem2D files are
@@ -191,79 +202,44 @@ else: # If the reference amplitude is not given: calculate one from source.txt
     if DEBUG_PLOT:
         plt.plot(t_source,aS,'+-g',label='Filtered downsampled source')
     ########### Zero pad up to next power of 2 ###########
-    t_source,aS=zeroPad(t_source,aS,N2-Ndown) # Zero-pad the source
+    # (rfft pads aS with zeros up to N2 itself, the padded arrays are only needed for plotting)
     if DEBUG_PLOT:
+        t_source,aS=zero_pad(t_source,aS,N2-Ndown) # Zero-pad the source
         plt.plot(t_source,aS,'+-k',label='Filtered downsampled zeropadded source')
         plt.legend()
     ############# Compute amplitude spectrum #############
-    Sf = abs(rfft(aS,N2)/Ndown)**2
+    Sf = powerSpectra(aS,N2,Ndown)
     freq_source = rfftfreq(N2,d=par_file.dt*NdownSampled)
     if DEBUG_PLOT:
         plt.figure()
         plt.plot(freq_source,Sf,'o-')
         plt.title('Source spectrum')
     ##### Interpolate to calculate amplitude at freq #####
-    idxInf=int(np.floor(freq/(freq_source[1]-freq_source[0])))
-    idxSup=int(idxInf+1)
-    ref_amplitude=((Sf[idxSup]-Sf[idxInf])/(freq_source[idxSup]-freq_source[idxInf])) \
-            * freq + (Sf[idxSup]*freq_source[idxInf]-Sf[idxInf]*freq_source[idxSup])/(freq_source[idxInf]-freq_source[idxSup])
+    if args.exact:
+        ref_amplitude=dftSpectra(aS[:N2],freqs,par_file.dt*NdownSampled,Ndown) # One value per frequency
+    else:
+        ref_amplitude=interpolateSpectra(Sf,freq_source[1]-freq_source[0],freqs) # One value per frequency
     if args.verbose:
-        print("Calculated reference amplitude at",freq,'Hz:',ref_amplitude)
+        print("Calculated reference amplitude at",freqs,'Hz:',ref_amplitude)
     if DEBUG_PLOT:
         plt.show()
 
 #ref2=np.abs(1j/4.*hankel1(0,2*np.pi*freq/c))
 
-############# Loop on files #############
-amplitudes=np.zeros(nStats) # To store amplitudes
-i = 0
-nSeismos = len(sorted(glob.glob(Dir+'AA.S*')))
+############# Compute all amplitudes #############
+sortedListOfNames = sorted(glob.glob(Dir+'AA.S*')) # All seismograms
+nSeismos = len(sortedListOfNames)
 print("Computing "+str(nSeismos)+" FFTs ...")
-for path_to_seismo in sorted(glob.glob(Dir+'AA.S*')): # All seismograms
-    print("  "+path_to_seismo+" (total number: "+str(nSeismos)+")")
-    ###################### READ FILE #####################
-    t_seismo,pres_seismo=ReadSeismo(path_to_seismo)
-    if DEBUG_PLOT:
-        plt.figure()
-        plt.hold(True)
-        plt.plot(t_seismo,pres_seismo,'+-b',label='Seismo brut')
-        plt.title(path_to_seismo)
-    ############### Down sample the signal ###############
-    t_seismo=t_seismo[::NdownSampled]
-    pres_seismo=pres_seismo[::NdownSampled]
-    #print("NdownSampled",NdownSampled," ",len(pres_seismo))
-    #print("DT: ",t_seismo[1]-t_seismo[0])
-    #print("Ndown: ",Ndown)
-    #print("N2: ",N2)
-    if DEBUG_PLOT:
-        plt.plot(t_seismo,pres_seismo,'+-r',label='Downsampled seismo')
-    ########### Zero pad up to next power of 2 ###########
-    t_seismo,pres_seismo=zeroPad(t_seismo,pres_seismo,N2-Ndown)
-    if DEBUG_PLOT:
-        plt.plot(t_seismo,pres_seismo,'+-g',label='Downsample zeropaded seismo')
-    # (The number of points is the same than for the source)
-    ############# Compute amplitude spectrum #############
-    s_seismo = abs(rfft(pres_seismo,N2)/Ndown)**2
-    freq_seismo = rfftfreq(N2,d=par_file.dt*NdownSampled) #t_source.shape[-1])
-    #print("rfftfreq(",N2,",",par_file.dt*NdownSampled,") = ",freq_seismo[0],freq_seismo[1],freq_seismo[2]," ...")
-    if DEBUG_PLOT:
-        plt.figure()
-        plt.plot(freq_seismo,s_seismo,'o-')
-        plt.title(path_to_seismo+' spectrum')
-    ###### Interpolate to calculate amplitude at freq #####
-    idxInf=int(np.floor(freq/(freq_seismo[1]-freq_seismo[0])))
-    idxSup=int(idxInf+1)
-    amplitudes[i]=((s_seismo[idxSup]-s_seismo[idxInf])/(freq_seismo[idxSup]-freq_seismo[idxInf])) \
-            * freq + (s_seismo[idxSup]*freq_seismo[idxInf]-s_seismo[idxInf]*freq_seismo[idxSup])/(freq_seismo[idxInf]-freq_seismo[idxSup])
-    #print("df : ",freq_seismo[1]-freq_seismo[0])
-    #print("IdxInf :",s_seismo[idxInf]," freq :",freq_seismo[idxInf])
-    #print("IdxSup :",s_seismo[idxSup]," freq :",freq_seismo[idxSup])
-    #print("amplitude :",amplitudes[i])
-    if args.verbose:
-        print("  Calculated amplitude at",freq,'Hz:',amplitudes[i])
-    if DEBUG_PLOT:
-        plt.show()
-    i=i+1
+# The seismograms are read in gathers of several stations, which are transformed by a single rfft
+# All the frequencies are evaluated on the same spectra: amplitudes is a matrix (stations x frequencies)
+if args.workers == 1:
+    amplitudes=stationAmplitudes(sortedListOfNames,freqs,par_file.dt,NdownSampled,Ndown,N2,exact=args.exact,verbose=True)
+else: # Same computation on chunks of stations distributed over a pool of processes
+    workers=args.workers if args.workers > 0 else multiprocessing.cpu_count()
+    amplitudes=poolAmplitudes(sortedListOfNames,freqs,par_file.dt,NdownSampled,Ndown,N2,workers,exact=args.exact,verbose=True)
+if args.verbose:
+    for idx in range(nSeismos):
+        print("  "+sortedListOfNames[idx]+": calculated amplitude at",freqs,'Hz:',amplitudes[idx])
 
 #from scipy.io import loadmat
 #fic = Dir+'/elast_s2b2sd590rd30f5_fem_dimitri_20150225.fig'
@@ -292,10 +268,32 @@ if args.verbose:
 
 loss=-10*np.log10(amplitudes/ref_amplitude)
 
-if not args.noplot:
-    plt.figure()
-    plt.plot(X,loss,'b') #,marker,linestyle=linestyle,color = (r,g,b),markersize=marker_size)
-    plt.gca().invert_yaxis()
-    plt.show()
-np.savetxt(args.outputPath,np.dstack((X,loss))[0])
-np.savetxt(args.outputPath+"ampl",np.dstack((X,amplitudes))[0])
+if args.freqs is None:
+    loss=loss[:,0]
+    amplitudes=amplitudes[:,0]
+    if not args.noplot:
+        plt.figure()
+        plt.plot(X,loss,'b') #,marker,linestyle=linestyle,color = (r,g,b),markersize=marker_size)
+        plt.gca().invert_yaxis()
+        plt.show()
+    np.savetxt(args.outputPath,np.dstack((X,loss))[0])
+    np.savetxt(args.outputPath+"ampl",np.dstack((X,amplitudes))[0])
+else:
+    # Matrix range x frequency: first column is the range, then one column per frequency
+    header="range "+" ".join(str(f) for f in freqs)
+    if not args.noplot:
+        plt.figure()
+        if len(freqs) == 1: # pcolormesh needs at least two frequencies
+            plt.plot(X,loss[:,0],'b')
+            plt.gca().invert_yaxis()
+            plt.title('%g Hz' % freqs[0])
+            plt.xlabel('Range')
+            plt.ylabel('Transmission losses (dB)')
+        else:
+            plt.pcolormesh(cellEdges(X),cellEdges(freqs),loss.T,cmap='jet_r')
+            plt.colorbar(label='Transmission losses (dB)')
+            plt.xlabel('Range')
+            plt.ylabel('Frequency (Hz)')
+        plt.show()
+    np.savetxt(args.outputPath,np.column_stack((X,loss)),header=header)
+    np.savetxt(args.outputPath+"ampl",np.column_stack((X,amplitudes)),header=header)
@@ -7,20 +7,28 @@ Python code to process data obtained with specfem2d
 Processing of the data obtained with a slope bottom
 
 /home/bottero/bin/mpiexec -n 5 python ./computeTL.py
+or without MPI, on the cores of one machine:
+python ./computeTLmpi.py --workers 8 ...
 
 @author: bottero
 """
 
 from __future__ import (absolute_import, division, print_function)
 import numpy as np
-from numpy.fft import rfftfreq, rfft
+from numpy.fft import rfftfreq
 import matplotlib.pyplot as plt
 #from scipy.special import hankel1
 import os.path
 import glob
 import argparse # To deal with arguments :
 # https://docs.python.org/2/library/argparse.html
-import mpi4py.MPI as MPI # MPI
+from seismogram_tools import zero_pad # Shared seismogram tools (link to utils/seismogram_tools.py)
+from transmissionLosses import powerSpectra, interpolateSpectra, stationAmplitudes, poolAmplitudes # Batched TL engine
+import multiprocessing
+try:
+    import mpi4py.MPI as MPI # MPI
+except ImportError:
+    MPI = None # Only the local process pool (--workers) can be used
 
 def distributeN(rank,P,N):
     """
@@ -67,34 +75,64 @@ def distributeN(rank,P,N):
     return rstart,rend
 
 
-def rankForIdx(idx,comm,N):
+def countsAndDisplacements(P,N):
     """
-    Inverse of previous function: return the rank of the processor that is in charge of given index.
+    Number of things of each rank and index of the first one (as needed by Gatherv)
+    for the distribution of distributeN.
+    """
+    counts = np.array([distributeN(rank,P,N)[1]-distributeN(rank,P,N)[0] for rank in range(P)])
+    displs = np.zeros(P,dtype=int)
+    displs[1:] = np.cumsum(counts)[:-1]
+    return counts,displs
 
-    Parameters
-    ----------
-    idx: int
-         Index of element concerned
-    comm: MPI communicator
-    N:  int
-        Total number of things distributed.
 
-    Returns
-    ----------
-    rank: rank of the processor that is in charge of idx
+TAG_TASK = 1   # MPI tag of the chunks sent by the master
+TAG_RESULT = 2 # MPI tag of the amplitudes sent back by the workers
 
-    Notes
-    ----------
-    Index is zero based.
+def scheduleChunks(comm,N,chunkSize,amplitudes):
+    """
+    Master side of the dynamic load balancing: hand out chunks of chunkSize consecutive
+    things to the workers (ranks 1 to P-1) as soon as they are done with their previous
+    chunk, and store their results in amplitudes.
+    Workers on larger files or slower storage simply get fewer chunks.
     """
+    chunks = [(start,min(start+chunkSize,N)) for start in range(0,N,chunkSize)]
+    nextChunk = 0
+    active = 0
+    for worker in range(1,comm.size):
+        if nextChunk < len(chunks):
+            comm.send(chunks[nextChunk],dest=worker,tag=TAG_TASK)
+            nextChunk += 1
+            active += 1
+        else:
+            comm.send(None,dest=worker,tag=TAG_TASK) # Nothing to do
+    status = MPI.Status()
+    while active > 0:
+        comm.Probe(source=MPI.ANY_SOURCE,tag=TAG_RESULT,status=status)
+        worker = status.Get_source()
+        result = np.empty(status.Get_count(MPI.DOUBLE))
+        comm.Recv([result,MPI.DOUBLE],source=worker,tag=TAG_RESULT)
+        start,end = int(result[0]),int(result[1])
+        amplitudes[start:end] = result[2:]
+        if nextChunk < len(chunks):
+            comm.send(chunks[nextChunk],dest=worker,tag=TAG_TASK)
+            nextChunk += 1
+        else:
+            comm.send(None,dest=worker,tag=TAG_TASK) # Done
+            active -= 1
 
-    idx2 = 0
-    rank = 0
-    while idx2 <= idx:
-        idx1,idx2 = distributeN(rank,comm.size,N)
-        rank = rank + 1
-    rank = rank - 1
-    return rank
+def workOnChunks(comm,computeChunk):
+    """
+    Worker side of the dynamic load balancing: compute the chunks (start,end) received from
+    the master with computeChunk(start,end) until the master sends None.
+    """
+    while True:
+        chunk = comm.recv(source=0,tag=TAG_TASK)
+        if chunk is None:
+            break
+        start,end = chunk
+        result = np.concatenate(([start,end],computeChunk(start,end)))
+        comm.Send([result,MPI.DOUBLE],dest=0,tag=TAG_RESULT)
 
 def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     """Filter the signal... Useless here..."""
@@ -192,20 +230,6 @@ def ReadStations(path):
     stats=np.loadtxt(path,usecols=(2,3))
     return stats[:,0],stats[:,1]
 
-def ReadSeismo(path):
-    data=np.loadtxt(path)
-    return data[:,0],data[:,1]
-
-def zeroPad(t,ft,nZeros):
-    """ From t and f(t) add points to t and zeros to f(t)
-    dt must be constant : t[1]-t[0]=t[2]-t[1]=...=t[n]-t[n-1]
-    """
-    dt=t[1]-t[0]
-    for i in np.arange(nZeros):
-        t=np.append(t,t[-1]+dt)
-        ft=np.append(ft,0.0)
-    return t,ft
-
 DEBUG_PLOT = False
 
 ####################### PARSE ARGUMENTS #######################
@@ -230,18 +254,41 @@ parser.add_argument('--refAmpl', type=float, default = -1.0,
     help='Reference amplitude at the frequency given')
 parser.add_argument('-m','--meters', action='store_true',
     help='Store x in meters')
+parser.add_argument('--chunkSize', type=int, default = 0,
+    help='Dynamic load balancing: rank 0 hands out chunks of chunkSize stations to the other ranks \
+          as soon as they are done with the previous one (default: 0, static blocks of stations)')
+parser.add_argument('--workers', type=int, default = None,
+    help='Number of local processes computing the spectra (0 uses all the cores), \
+          instead of MPI (mpi4py not needed). Default: MPI, or all the cores if mpi4py is not installed')
 parser.add_argument('-v','--verbose', action='store_true',
     help='display more information')
 
 args = parser.parse_args()
 
-comm = MPI.COMM_WORLD
+if args.workers is None and MPI is None:
+    print("mpi4py not found: using a pool of local processes")
+    args.workers = 0
+if args.workers is not None and args.workers <= 0:
+    args.workers = multiprocessing.cpu_count()
+
+if args.workers is not None: # Local process pool, this is the only process of the script
+    comm = None
+    rank = 0
+    size = args.workers
+else:
+    comm = MPI.COMM_WORLD
+    rank = comm.rank
+    size = comm.size
 
-if comm.rank == 0:
+if rank == 0:
     print("-"*78)
-    print(" Running on %d cores" % comm.size)
+    if comm is None:
+        print(" Running on %d local processes" % size)
+    else:
+        print(" Running on %d cores" % size)
     print("-"*78)
-comm.Barrier()
+if comm is not None:
+    comm.Barrier()
 
 ###################### OPTIONS #######################
 NdownSampled=args.NdownSampled # Downsampling
@@ -280,22 +327,20 @@ else: # If the reference amplitude is not given: calculate one from source.txt
     if DEBUG_PLOT:
         plt.plot(t_source,aS,'+-g',label='Source filtree downsamplee')
     ########### Zero pad up to next power of 2 ###########
-    t_source,aS=zeroPad(t_source,aS,N2-Ndown) # Zero-pad the source
+    # (rfft pads aS with zeros up to N2 itself, the padded arrays are only needed for plotting)
     if DEBUG_PLOT:
+        t_source,aS=zero_pad(t_source,aS,N2-Ndown) # Zero-pad the source
         plt.plot(t_source,aS,'+-k',label='Source filtree downsamplee zeropadee')
         plt.legend()
     ############# Compute amplitude spectrum #############
-    Sf = abs(rfft(aS,N2)/Ndown)#**2
+    Sf = powerSpectra(aS,N2,Ndown,squared=False)
     freq_source = rfftfreq(N2,d=par_file.dt*NdownSampled)
     if DEBUG_PLOT:
         plt.figure()
         plt.plot(freq_source,Sf,'o-')
         plt.title('Source spectrum')
     ##### Interpolate to calculate amplitude at freq #####
-    idxInf=int(np.floor(freq/(freq_source[1]-freq_source[0])))
-    idxSup=int(idxInf+1)
-    ref_amplitude=((Sf[idxSup]-Sf[idxInf])/(freq_source[idxSup]-freq_source[idxInf])) \
-            * freq + (Sf[idxSup]*freq_source[idxInf]-Sf[idxInf]*freq_source[idxSup])/(freq_source[idxInf]-freq_source[idxSup])
+    ref_amplitude=interpolateSpectra(Sf,freq_source[1]-freq_source[0],freq)[0]
     if args.verbose:
         print("Calculated reference amplitude at",freq,'Hz:',ref_amplitude)
     if DEBUG_PLOT:
@@ -303,58 +348,45 @@ else: # If the reference amplitude is not given: calculate one from source.txt
 
 #ref2=np.abs(1j/4.*hankel1(0,2*np.pi*freq/c))
 
-############# Loop on files #############
-amplitudes=np.zeros(nStats) # To store amplitudes
 sortedListOfNames = sorted(glob.glob(Dir+'AA.S*'))
-nSeismos = len(sorted(glob.glob(Dir+'AA.S*')))
-print("Computing "+str(nSeismos)+" FFTs ...")
-idx1,idx2 = distributeN(comm.rank,comm.size,nSeismos)
-
-#for path_to_seismo in sorted(glob.glob(Dir+'AA.S*')): # All seismograms
-for idx in range(idx1,idx2):
-    path_to_seismo = sortedListOfNames[idx]
-    print("Proc",comm.rank,"calculates:",path_to_seismo)
-    ###################### READ FILE #####################
-    t_seismo,pres_seismo=ReadSeismo(path_to_seismo)
-    if DEBUG_PLOT:
-        plt.figure()
-        plt.hold(True)
-        plt.plot(t_seismo,pres_seismo,'+-b',label='Seismo brut')
-        plt.title(path_to_seismo)
-    ############### Down sample the signal ###############
-    t_seismo=t_seismo[::NdownSampled]
-    pres_seismo=pres_seismo[::NdownSampled]
-    if DEBUG_PLOT:
-        plt.plot(t_seismo,pres_seismo,'+-r',label='Seismo downsample')
-    ########### Zero pad up to next power of 2 ###########
-    t_seismo,pres_seismo=zeroPad(t_seismo,pres_seismo,N2-Ndown)
-    if DEBUG_PLOT:
-        plt.plot(t_seismo,pres_seismo,'+-g',label='Seismo downsample zeropadde')
-    # (The number of points is the same than for the source)
-    ############# Compute amplitude spectrum #############
-    s_seismo = abs(rfft(pres_seismo,N2)/Ndown)**2
-    freq_seismo = rfftfreq(N2,d=par_file.dt*NdownSampled) #t_source.shape[-1])
-    if DEBUG_PLOT:
-        plt.figure()
-        plt.plot(freq_seismo,s_seismo,'o-')
-        plt.title(path_to_seismo+' spectrum')
-    ###### Interpolate to calculate amplitude at freq #####
-    idxInf=int(np.floor(freq/(freq_seismo[1]-freq_seismo[0])))
-    idxSup=int(idxInf+1)
-    amplitudes[idx]=((s_seismo[idxSup]-s_seismo[idxInf])/(freq_seismo[idxSup]-freq_seismo[idxInf])) \
-            * freq + (s_seismo[idxSup]*freq_seismo[idxInf]-s_seismo[idxInf]*freq_seismo[idxSup])/(freq_seismo[idxInf]-freq_seismo[idxSup])
-    comm.send(amplitudes[idx],dest=0)
+nSeismos = len(sortedListOfNames)
+if rank == 0:
+    print("Computing "+str(nSeismos)+" FFTs ...")
+
+def computeChunk(idx1,idx2):
+    """ Amplitudes of the stations idx1 to idx2-1 """
+    print("Proc",rank,"calculates stations",idx1+1,"to",idx2)
+    # The seismograms are read in gathers, which are transformed by a single rfft
+    chunkAmplitudes=stationAmplitudes(sortedListOfNames[idx1:idx2],freq,par_file.dt,NdownSampled,Ndown,N2)[:,0]
     if args.verbose:
-        print("Calculated amplitude at",freq,'Hz:',amplitudes[idx])
-    if DEBUG_PLOT:
-        plt.show()
+        for idx in range(idx1,idx2):
+            print("Calculated amplitude at",freq,'Hz:',chunkAmplitudes[idx-idx1],'('+sortedListOfNames[idx]+')')
+    return chunkAmplitudes
+
+amplitudes=np.zeros(nStats) # To store amplitudes
+if comm is None:
+    ############# Local process pool: same kernel (stationAmplitudes) on chunks of stations #############
+    amplitudes[:nSeismos]=poolAmplitudes(sortedListOfNames,freq,par_file.dt,NdownSampled,Ndown,N2,size,
+                                         chunkSize=args.chunkSize,verbose=True)[:,0]
+    if args.verbose:
+        for idx in range(nSeismos):
+            print("Calculated amplitude at",freq,'Hz:',amplitudes[idx],'('+sortedListOfNames[idx]+')')
+elif args.chunkSize > 0 and comm.size > 1:
+    ############# Dynamic load balancing: rank 0 distributes chunks of stations #############
+    if comm.rank == 0:
+        scheduleChunks(comm,nSeismos,args.chunkSize,amplitudes)
+    else:
+        workOnChunks(comm,computeChunk)
+else:
+    ############# Compute the amplitudes of the stations of this rank #############
+    idx1,idx2 = distributeN(comm.rank,comm.size,nSeismos)
+    localAmplitudes=computeChunk(idx1,idx2)
 
-comm.Barrier() # Wait for all proc to finish
+    ############# Gather all the amplitudes on rank 0 #############
+    counts,displs = countsAndDisplacements(comm.size,nSeismos)
+    comm.Gatherv(localAmplitudes,[amplitudes,counts,displs,MPI.DOUBLE],root=0) # One collective instead of a message per station
 
-if comm.rank == 0:
-    for idx in range(idx2,nStats):
-        amplitudes[idx] = comm.recv(source=rankForIdx(idx,comm,nStats))
-        #print("idx:",idx,"has been calculated by rank:",rankForIdx(idx,comm,N))
+if rank == 0:
     if args.verbose:
         print("Proc 0 got finally:",amplitudes)
         print("ref_amplitude:",ref_amplitude)
@@ -380,7 +412,7 @@ if comm.rank == 0:
 #            plt.ylabel("%s" % line.properties.String,fontsize = 16)
 #            counter += 1
 
-if comm.rank == 0:
+if rank == 0:
     loss=-10*np.log10(amplitudes/ref_amplitude)
     if not args.noplot:
         plt.figure()
@@ -390,4 +422,5 @@ if comm.rank == 0:
     np.savetxt(args.outputPath,np.dstack((X,loss))[0])
     np.savetxt(args.outputPath+"ampl",np.dstack((X,amplitudes))[0])
 
-comm.Barrier()
+if comm is not None:
+    comm.Barrier()
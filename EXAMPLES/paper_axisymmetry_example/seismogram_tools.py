@@ -0,0 +1 @@
+../../utils/seismogram_tools.py
\ No newline at end of file
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Transmission losses engine shared by computeTL.py and computeTLmpi.py
+
+The seismograms of a set of stations are read into a 2-D array (stations x time samples),
+transformed by a single batched rfft along the time axis and their spectra are evaluated
+at all the frequencies requested at once.
+Alternatively the spectra can be evaluated exactly at the frequencies requested by a direct
+DFT (no zero padding and no interpolation between frequency bins).
+
+"""
+
+from __future__ import (absolute_import, division, print_function)
+import multiprocessing
+import numpy as np
+from numpy.fft import rfft
+from seismogram_tools import read_ascii_seismogram # Shared seismogram readers (link to utils/seismogram_tools.py)
+
+CHUNK_SIZE = 256 # Number of stations transformed together (bounds the memory used by the gathers)
+DFT_BLOCK_SIZE = 2**22 # Maximum number of values of the DFT matrices (time samples x frequencies)
+
+def parseFrequencies(string):
+    """ Read a list of frequencies given as "f1,f2,f3,..." or a band given as "fmin:fmax:step"
+    (fmax included). Return a sorted array of frequencies
+    """
+    if ':' in string:
+        values = [float(v) for v in string.split(':')]
+        if len(values) != 3 or values[2] <= 0 or values[1] < values[0]:
+            raise ValueError('Frequency band must be given as fmin:fmax:step, got '+string)
+        fmin,fmax,step = values
+        nFreqs = int(np.floor((fmax-fmin)/step*(1+1e-10)))+1 # (fmax included despite round-off)
+        return fmin + step*np.arange(nFreqs)
+    freqs = np.array([float(v) for v in string.split(',') if v.strip()])
+    if len(freqs) == 0:
+        raise ValueError('No frequency given in '+string)
+    return np.sort(freqs)
+
+def readGather(paths,NdownSampled=1,nMax=None):
+    """ Read the seismograms of the files given into a 2-D array (stations x samples)
+    keeping one point over NdownSampled. Traces are cut at nMax samples (if given),
+    shorter traces are padded with zeros
+    """
+    traces = [read_ascii_seismogram(path)[1][::NdownSampled] for path in paths]
+    n = max(len(trace) for trace in traces)
+    if nMax is not None:
+        n = min(n,nMax)
+    gather = np.zeros((len(traces),n))
+    for i,trace in enumerate(traces):
+        m = min(len(trace),n)
+        gather[i,:m] = trace[:m]
+    return gather
+
+def powerSpectra(gather,N2,Ndown,squared=True):
+    """ Amplitude spectra of all the traces of a gather (along last axis), zero-padded
+    up to N2 samples and normalized by the number of samples Ndown. Squared if asked
+    """
+    spectra = np.abs(rfft(gather,N2,axis=-1)/Ndown)
+    if squared:
+        spectra **= 2
+    return spectra
+
+def interpolateSpectra(spectra,df,freqs):
+    """ Linear interpolation of the spectra (..., frequencies) sampled every df
+    at the frequencies freqs. Return an array (..., len(freqs))
+    """
+    freqs = np.atleast_1d(np.asarray(freqs,dtype=float))
+    idxInf = np.floor(freqs/df).astype(int)
+    idxSup = idxInf+1
+    if np.any(idxInf < 0) or np.any(idxSup >= spectra.shape[-1]):
+        raise ValueError('Frequencies must be between 0 and the Nyquist frequency '+str(df*(spectra.shape[-1]-1)))
+    w = freqs/df - idxInf # Weight of upper frequency bin
+    return spectra[...,idxInf]*(1-w) + spectra[...,idxSup]*w
+
+def dftSpectra(gather,freqs,dtDown,Ndown,squared=True):
+    """ Amplitude spectra of all the traces of a gather (along last axis) evaluated exactly at
+    the frequencies freqs by a direct DFT: sum over n of x[n]*exp(-2i*pi*f*n*dtDown), normalized
+    by Ndown like powerSpectra(). This is the limit of the zero-padded rfft for an infinite padding.
+    The cost is O(N) per trace and frequency (one matrix product for all the traces).
+    Return an array (..., len(freqs)). Squared if asked
+    """
+    freqs = np.atleast_1d(np.asarray(freqs,dtype=float))
+    n = gather.shape[-1]
+    re = np.zeros(gather.shape[:-1]+(len(freqs),))
+    im = np.zeros(gather.shape[:-1]+(len(freqs),))
+    blockSize = max(1,DFT_BLOCK_SIZE//max(1,len(freqs))) # Number of time samples per block
+    for start in range(0,n,blockSize):
+        end = min(start+blockSize,n)
+        # Phase in cycles, reduced modulo 1 to keep it accurate for long traces
+        cycles = np.outer(np.arange(start,end),freqs*dtDown) % 1.0
+        re += np.dot(gather[...,start:end],np.cos(2*np.pi*cycles))
+        im -= np.dot(gather[...,start:end],np.sin(2*np.pi*cycles))
+    spectra = np.sqrt(re**2+im**2)/Ndown
+    if squared:
+        spectra **= 2
+    return spectra
+
+def stationAmplitudes(paths,freqs,dt,NdownSampled,Ndown,N2,chunkSize=CHUNK_SIZE,exact=False,verbose=False):
+    """ Compute the squared spectral amplitudes of the seismograms given at the frequencies freqs.
+    dt is the time step of the seismograms before downsampling.
+    The stations are processed in chunks of chunkSize stations: each chunk is read into a gather
+    and transformed by one rfft (or by a direct DFT at the exact frequencies if exact is True).
+    Return an array (len(paths) x len(freqs))
+    """
+    freqs = np.atleast_1d(freqs)
+    df = 1.0/(N2*dt*NdownSampled) # Frequency step of rfftfreq(N2,d=dt*NdownSampled)
+    amplitudes = np.zeros((len(paths),len(freqs)))
+    for start in range(0,len(paths),chunkSize):
+        end = min(start+chunkSize,len(paths))
+        if verbose:
+            print("  Stations "+str(start+1)+" to "+str(end)+" (total number: "+str(len(paths))+")")
+        gather = readGather(paths[start:end],NdownSampled,N2)
+        if exact:
+            amplitudes[start:end] = dftSpectra(gather,freqs,dt*NdownSampled,Ndown)
+        else:
+            amplitudes[start:end] = interpolateSpectra(powerSpectra(gather,N2,Ndown),df,freqs)
+    return amplitudes
+
+def _chunkAmplitudes(task):
+    """ Kernel of the process pool: amplitudes of one chunk of stations
+    task is a tuple (paths,freqs,dt,NdownSampled,Ndown,N2,exact) """
+    paths,freqs,dt,NdownSampled,Ndown,N2,exact = task
+    return stationAmplitudes(paths,freqs,dt,NdownSampled,Ndown,N2,exact=exact)
+
+def poolAmplitudes(paths,freqs,dt,NdownSampled,Ndown,N2,workers,chunkSize=None,exact=False,verbose=False):
+    """ Same as stationAmplitudes() but the chunks of stations are computed by a pool of
+    workers local processes (no MPI needed). The chunks are handed out to the processes as soon
+    as they are done with the previous one. By default the chunks are small enough to give several
+    chunks to each process. Return an array (len(paths) x len(freqs))
+    """
+    freqs = np.atleast_1d(freqs)
+    if chunkSize is None or chunkSize <= 0:
+        chunkSize = max(1,min(CHUNK_SIZE,int(np.ceil(len(paths)/(4.0*workers)))))
+    starts = range(0,len(paths),chunkSize)
+    tasks = [(paths[start:start+chunkSize],freqs,dt,NdownSampled,Ndown,N2,exact) for start in starts]
+    amplitudes = np.zeros((len(paths),len(freqs)))
+    pool = multiprocessing.Pool(processes=workers)
+    for start,chunkAmplitudes in zip(starts,pool.imap(_chunkAmplitudes,tasks)):
+        if verbose:
+            print("  Stations "+str(start+1)+" to "+str(start+len(chunkAmplitudes))+" (total number: "+str(len(paths))+")")
+        amplitudes[start:start+len(chunkAmplitudes)] = chunkAmplitudes
+    pool.close()
+    pool.join()
+    return amplitudes
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+#
+# shared routines to interpolate scattered SPECFEM2D point data (energy fields, kernels, ...)
+# onto regular grids, used by plotIntegratedEnergyFile.py and plot_kernel.py
+#
+# the Delaunay triangulation of a point set is built once and stored in an on-disk cache,
+# one .npz file per point set keyed by a hash of the coordinates; linear interpolation onto a grid
+# is then a sparse matrix (grid points x data points) of barycentric weights, built once per grid
+# and applied to any number of fields by sparse matrix-vector products; only the values of the
+# data points used by the grid get read (memory bounded by the grid size, not by the number of points)
+#
+# gives the same result as matplotlib.mlab.griddata(x, z, values, xi, zi, interp='linear')
+# (deprecated in matplotlib 2.2, removed in 3.1)
+#
+# point sets made of the GLL points of spectral elements, written element by element
+# (like the kernel files of save_adjoint_kernels.f90), can be interpolated without Delaunay triangulation:
+# the cells between neighbouring GLL points of each element are split into 2 triangles which get
+# binned into the cells of the regular grid they overlap, in linear time and bounded memory
+#
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import hashlib
+import numpy as np
+import scipy.sparse
+import matplotlib.tri as mtri
+
+# maximum number of (triangle, grid point) pairs tested at once by the element-based interpolator
+CANDIDATES_BLOCK_SIZE = 2**22
+
+# tolerance on barycentric coordinates for grid points on the edges of the triangles
+BARYCENTRIC_TOL = 1.e-10
+
+
+def coordinates_hash(x, z):
+    """
+    returns a hash (hex string) of the point coordinates, identifies a point set (same mesh)
+    """
+    key = hashlib.sha1()
+    for coord in (x, z):
+        coord = np.ascontiguousarray(coord, dtype=np.float64)
+        key.update(str(coord.shape).encode('utf-8'))
+        key.update(coord.data)
+    return key.hexdigest()
+
+
+def align_points(x, z, x2, z2):
+    """
+    returns the indices of the points (x2,z2) in the order of the points (x,z), such that fields given
+    on both point sets can be combined point by point: slice(None) if the coordinates are the same
+    (same hash), an index array if the points are a permutation of each other (e.g. another partitioning
+    of the mesh), None if the point sets differ or if a permutation would be ambiguous (duplicated points)
+    """
+    if len(x) != len(x2):
+        return None
+    if coordinates_hash(x, z) == coordinates_hash(x2, z2):
+        return slice(None)
+    order1 = np.lexsort((z, x))
+    order2 = np.lexsort((z2, x2))
+    xs = np.asarray(x)[order1]
+    zs = np.asarray(z)[order1]
+    if not (np.array_equal(xs, np.asarray(x2)[order2]) and np.array_equal(zs, np.asarray(z2)[order2])):
+        return None
+    if np.any((np.diff(xs) == 0) & (np.diff(zs) == 0)):
+        return None
+    order = np.empty(len(x), dtype=np.int64)
+    order[order1] = order2
+    return order
+
+
+def get_triangulation_file(cache_dir, key):
+    """
+    returns the name of the cache file storing the triangulation of a point set
+    """
+    return os.path.join(cache_dir, 'triangulation_' + key + '.npz')
+
+
+class GridInterpolator(object):
+    """
+    linear interpolation of fields given at the points (x,z) onto regular grids
+
+    the triangulation is built (or read from the cache directory) once,
+    the barycentric weights are kept for each grid they have been computed for
+    """
+
+    def __init__(self, x, z, cache_dir=None, verbose=False, key=None):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.z = np.asarray(z, dtype=np.float64)
+        if self.x.shape != self.z.shape or self.x.ndim != 1:
+            raise ValueError("x and z must be equal-length 1-D arrays")
+        self.key = key if key is not None else coordinates_hash(self.x, self.z)
+        self.cache_dir = cache_dir
+        self.verbose = verbose
+        self._triangulation = None
+        self._weights = {}
+
+    @property
+    def triangulation(self):
+        """
+        Delaunay triangulation of the points (from the cache if possible)
+        """
+        if self._triangulation is None:
+            triangles = None
+            cache_file = None
+            if self.cache_dir:
+                cache_file = get_triangulation_file(self.cache_dir, self.key)
+                if os.path.isfile(cache_file):
+                    try:
+                        with np.load(cache_file) as cache:
+                            triangles = cache['triangles']
+                        if self.verbose:
+                            print("Triangulation read from cache file "+cache_file)
+                    except Exception:
+                        # broken cache file, gets rewritten
+                        triangles = None
+            if triangles is None:
+                if self.verbose:
+                    print("Triangulation of "+str(len(self.x))+" points...")
+                triangles = mtri.Triangulation(self.x, self.z).triangles
+                if cache_file is not None:
+                    self.save_triangles(cache_file, triangles)
+            self._triangulation = mtri.Triangulation(self.x, self.z, triangles)
+        return self._triangulation
+
+    def save_triangles(self, cache_file, triangles):
+        """
+        stores the triangles in the cache (temporary file first, concurrent runs never read a partial file)
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_file = cache_file + '.%d.tmp' % os.getpid()
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, triangles=triangles)
+        os.rename(tmp_file, cache_file)
+        if self.verbose:
+            print("Triangulation written to cache file "+cache_file)
+
+    def weights(self, xi, zi):
+        """
+        returns the sparse matrix of barycentric weights (number of grid points x number of data points used),
+        the indices of the data points used and the mask of the grid points outside of the triangulation,
+        for the grid given by the 1-D coordinate vectors xi, zi (grid of shape (len(zi), len(xi)))
+        """
+        xi = np.asarray(xi, dtype=np.float64)
+        zi = np.asarray(zi, dtype=np.float64)
+        grid_key = (xi.tobytes(), zi.tobytes())
+        if grid_key not in self._weights:
+            matrix, outside = self.compute_weights(xi, zi)
+            # keeps the columns of the data points used only
+            used, columns = np.unique(matrix.indices, return_inverse=True)
+            matrix = scipy.sparse.csr_matrix((matrix.data, columns, matrix.indptr),
+                                             shape=(matrix.shape[0], len(used)))
+            self._weights[grid_key] = (matrix, used, outside)
+        return self._weights[grid_key]
+
+    def compute_weights(self, xi, zi):
+        """
+        locates the grid points in the triangles and computes their barycentric coordinates
+        """
+        triangulation = self.triangulation
+        X, Z = np.meshgrid(xi, zi)
+        X = X.ravel()
+        Z = Z.ravel()
+        itri = triangulation.get_trifinder()(X, Z)
+        outside = itri < 0
+        inside = np.flatnonzero(~outside)
+
+        vertices = triangulation.triangles[itri[inside]]
+        x1, x2, x3 = [self.x[vertices[:, k]] for k in range(3)]
+        z1, z2, z3 = [self.z[vertices[:, k]] for k in range(3)]
+        X = X[inside]
+        Z = Z[inside]
+        det = (z2 - z3) * (x1 - x3) + (x3 - x2) * (z1 - z3)
+        l1 = ((z2 - z3) * (X - x3) + (x3 - x2) * (Z - z3)) / det
+        l2 = ((z3 - z1) * (X - x3) + (x1 - x3) * (Z - z3)) / det
+        l3 = 1.0 - l1 - l2
+
+        rows = np.repeat(inside, 3)
+        values = np.column_stack((l1, l2, l3)).ravel()
+        matrix = scipy.sparse.csr_matrix((values, (rows, vertices.ravel())),
+                                         shape=(len(outside), len(self.x)))
+        return matrix, outside.reshape(len(zi), len(xi))
+
+    def grid(self, values, xi, zi):
+        """
+        interpolates the field values (one value per point) onto the grid xi, zi
+
+        returns a masked array of shape (len(zi), len(xi)), masked outside of the triangulation;
+        several fields on the same points, given as 2-D array (points x fields), get interpolated
+        in a single pass into an array of shape (fields, len(zi), len(xi))
+        """
+        matrix, used, outside = self.weights(xi, zi)
+        gridded = matrix.dot(np.asarray(values)[used].astype(np.float64))
+        if gridded.ndim == 1:
+            return np.ma.masked_array(gridded.reshape(outside.shape), mask=outside)
+        gridded = gridded.T.reshape((gridded.shape[1],) + outside.shape)
+        return np.ma.masked_array(gridded, mask=np.repeat(outside[np.newaxis], gridded.shape[0], axis=0))
+
+
+def element_triangles(ngll, ispec_start, ispec_end):
+    """
+    returns the triangles (3 point indices each) splitting the elements ispec_start to ispec_end - 1
+    of a GLL point set written element by element (ngll x ngll points per element, index i along x
+    varying fastest), 2 triangles per cell between neighbouring GLL points
+    """
+    i, j = np.meshgrid(np.arange(ngll - 1), np.arange(ngll - 1))
+    p00 = (j * ngll + i).ravel()
+    p10 = p00 + 1
+    p01 = p00 + ngll
+    p11 = p01 + 1
+    cells = np.concatenate((np.column_stack((p00, p10, p11)), np.column_stack((p00, p11, p01))))
+    offsets = np.arange(ispec_start, ispec_end, dtype=np.int64) * ngll * ngll
+    return (offsets[:, np.newaxis, np.newaxis] + cells[np.newaxis, :, :]).reshape(-1, 3)
+
+
+def grid_spacing(coords):
+    """
+    returns origin and step of a uniform grid coordinate vector
+    """
+    if len(coords) < 2:
+        return coords[0], 1.0
+    step = (coords[-1] - coords[0]) / (len(coords) - 1)
+    if not np.allclose(np.diff(coords), step, rtol=1.e-6, atol=0.0):
+        raise ValueError("element-based interpolation needs a uniform grid")
+    return coords[0], step
+
+
+class GLLInterpolator(GridInterpolator):
+    """
+    linear interpolation of fields given at the GLL points of spectral elements onto regular grids
+
+    no Delaunay triangulation: the triangles come from the element structure, grid points get located
+    in the triangles overlapping their grid cell; values of different elements are never mixed
+    (kernels are discontinuous between elements)
+    """
+
+    def __init__(self, x, z, ngll=5, verbose=False, key=None):
+        GridInterpolator.__init__(self, x, z, None, verbose, key)
+        if len(self.x) % (ngll * ngll) != 0:
+            raise ValueError("number of points %d is not a multiple of ngll x ngll = %d" % (len(self.x), ngll * ngll))
+        self.ngll = ngll
+        self.nspec = len(self.x) // (ngll * ngll)
+
+    def compute_weights(self, xi, zi):
+        """
+        bins the triangles into the grid cells and computes the barycentric coordinates of the grid points,
+        by blocks of elements (bounded memory)
+        """
+        nx = len(xi)
+        nz = len(zi)
+        grid = (xi, zi) + grid_spacing(xi) + grid_spacing(zi)
+        pixels = []
+        vertices = []
+        weights = []
+        nspec_block = max(1, CANDIDATES_BLOCK_SIZE // (8 * (self.ngll - 1)**2))
+        for ispec in range(0, self.nspec, nspec_block):
+            triangles = element_triangles(self.ngll, ispec, min(ispec + nspec_block, self.nspec))
+            for block in self.locate(triangles, grid):
+                pixels.append(block[0])
+                vertices.append(block[1])
+                weights.append(block[2])
+
+        # grid points on edges are inside several triangles: keeps the first one
+        if pixels:
+            pixels, first = np.unique(np.concatenate(pixels), return_index=True)
+            vertices = np.concatenate(vertices)[first]
+            weights = np.concatenate(weights)[first]
+        else:
+            pixels = np.zeros(0, dtype=np.int64)
+            vertices = np.zeros((0, 3), dtype=np.int64)
+            weights = np.zeros((0, 3))
+        outside = np.ones(nx * nz, dtype=bool)
+        outside[pixels] = False
+
+        rows = np.repeat(pixels, 3)
+        matrix = scipy.sparse.csr_matrix((weights.ravel(), (rows, vertices.ravel())),
+                                         shape=(nx * nz, len(self.x)))
+        return matrix, outside.reshape(nz, nx)
+
+    def locate(self, triangles, grid):
+        """
+        yields the grid points inside the triangles given (index in the flattened grid),
+        the vertices of their triangle and their barycentric coordinates,
+        testing at most CANDIDATES_BLOCK_SIZE (triangle, grid point) pairs at once
+        """
+        xi, zi, x0, dx, z0, dz = grid
+        nx = len(xi)
+        nz = len(zi)
+        xt = self.x[triangles]
+        zt = self.z[triangles]
+
+        # range of grid points within the bounding box of each triangle
+        ixmin = np.clip(np.ceil((xt.min(axis=1) - x0) / dx - BARYCENTRIC_TOL), 0, nx).astype(np.int64)
+        ixmax = np.clip(np.floor((xt.max(axis=1) - x0) / dx + BARYCENTRIC_TOL), -1, nx - 1).astype(np.int64)
+        izmin = np.clip(np.ceil((zt.min(axis=1) - z0) / dz - BARYCENTRIC_TOL), 0, nz).astype(np.int64)
+        izmax = np.clip(np.floor((zt.max(axis=1) - z0) / dz + BARYCENTRIC_TOL), -1, nz - 1).astype(np.int64)
+        ncols = np.maximum(ixmax - ixmin + 1, 0)
+        counts = ncols * np.maximum(izmax - izmin + 1, 0)
+        det = (zt[:, 1] - zt[:, 2]) * (xt[:, 0] - xt[:, 2]) + (xt[:, 2] - xt[:, 1]) * (zt[:, 0] - zt[:, 2])
+        counts[det == 0.0] = 0 # degenerated cells
+
+        candidates = np.flatnonzero(counts)
+        ends = np.cumsum(counts[candidates])
+        start = 0
+        while start < len(candidates):
+            limit = (ends[start - 1] if start > 0 else 0) + CANDIDATES_BLOCK_SIZE
+            end = max(start + 1, np.searchsorted(ends, limit, side='right'))
+            itri = candidates[start:end]
+            n = counts[itri]
+            t = np.repeat(itri, n)
+            k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+            ix = ixmin[t] + k % ncols[t]
+            iz = izmin[t] + k // ncols[t]
+            X = xi[ix]
+            Z = zi[iz]
+            x1, x2, x3 = xt[t, 0], xt[t, 1], xt[t, 2]
+            z1, z2, z3 = zt[t, 0], zt[t, 1], zt[t, 2]
+            l1 = ((z2 - z3) * (X - x3) + (x3 - x2) * (Z - z3)) / det[t]
+            l2 = ((z3 - z1) * (X - x3) + (x1 - x3) * (Z - z3)) / det[t]
+            l3 = 1.0 - l1 - l2
+            inside = (l1 >= -BARYCENTRIC_TOL) & (l2 >= -BARYCENTRIC_TOL) & (l3 >= -BARYCENTRIC_TOL)
+            yield ((iz * nx + ix)[inside], triangles[t[inside]], np.column_stack((l1, l2, l3))[inside])
+            start = end
+
+
+# interpolators of the point sets used so far (keyed by coordinate hash and number of GLL points)
+_interpolators = {}
+
+def get_interpolator(x, z, cache_dir=None, verbose=False, ngll=None):
+    """
+    returns the interpolator of the point set (x,z), shared by all the fields on the same points
+
+    with ngll given, the points are the ngll x ngll GLL points of each element, written element by element,
+    and get interpolated without triangulation
+    """
+    key = coordinates_hash(x, z)
+    if (key, ngll) not in _interpolators:
+        if ngll:
+            _interpolators[(key, ngll)] = GLLInterpolator(x, z, ngll, verbose, key)
+        else:
+            _interpolators[(key, ngll)] = GridInterpolator(x, z, cache_dir, verbose, key)
+    return _interpolators[(key, ngll)]
+
+
+def griddata(x, z, values, xi, zi, cache_dir=None, verbose=False, ngll=None):
+    """
+    linear interpolation of the field values given at the points (x,z) onto the grid
+    defined by the 1-D coordinate vectors xi, zi; masked outside of the convex hull of the points
+    (outside of the elements with ngll given)
+    """
+    return get_interpolator(x, z, cache_dir, verbose, ngll).grid(values, xi, zi)
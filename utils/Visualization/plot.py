@@ -16,6 +16,7 @@ import matplotlib.mlab as mlab  # Numerical python functions written for compata
 import matplotlib.cm as cm      # This module provides a large set of colormaps and other related tools
 from pylab import specgram
 from numpy.fft import rfftfreq, rfft
+from seismogram_tools import zero_pad # Shared utilities (link to utils/seismogram_tools.py)
 import os
 from sys import exit
 import math as M
@@ -218,16 +219,6 @@ def spectrogram(data, samp_rate, per_lap=0.9, wlen=None, log=False,
     else:
         return ax
 
-def zeroPad(t,ft,nZeros):
-    """ From t and f(t) add points to t and zeros to f(t)
-    dt must be constant : t[1]-t[0]=t[2]-t[1]=...=t[n]-t[n-1]
-    """
-    dt=t[1]-t[0]
-    for i in np.arange(nZeros):
-        t=np.append(t,t[-1]+dt)
-        ft=np.append(ft,0.0)
-    return t,ft
-
 parser = argparse.ArgumentParser(
     description='Analyse seismograms generated by SPECFEM')
 parser.add_argument('-s','--spectrum',nargs='?',type=int, choices=[1,2,4,8,16,32],
@@ -385,7 +376,7 @@ for idx,seismo in enumerate(args.files):      # Loop on the files given
         plt.figure()
     if plot_spectrum:
         N2=2**(nt-1).bit_length()*pad   # (Smallest power of 2 greater than length)*pad
-        t_seismo,ampl_seismo=zeroPad(t_seismo,ampl_seismo,N2-nt) # Zero-pad the seismogram
+        t_seismo,ampl_seismo=zero_pad(t_seismo,ampl_seismo,N2-nt) # Zero-pad the seismogram
         Sf = abs(rfft(ampl_seismo,N2)/nt)  # Perform Fourier transform
         freq_seismo = rfftfreq(N2,d=dt) # Compute frequency vector
         if scaleFilesWithFirstOne:
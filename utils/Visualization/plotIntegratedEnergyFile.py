@@ -9,14 +9,21 @@ Draw integrated energy plot
 """
 from __future__ import (absolute_import, division, print_function)
 import numpy as np # NumPy (multidimensional arrays, linear algebra, ...)
-import matplotlib.pyplot as plt
+import matplotlib
 import matplotlib.cm as cm
-import matplotlib.mlab as mlab
-import os,sys,glob,shutil
+import os,sys,glob,time,json
+import multiprocessing
 import argparse # To deal with arguments :
 # https://docs.python.org/2/library/argparse.html
 import scipy.ndimage
 from scipy import interpolate
+from gridding_tools import get_interpolator, align_points # Cached triangulation and barycentric weights
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir)) # seismogram_tools.py is in utils/
+try:
+    from seismogram_tools import read_ascii_columns, count_ascii_rows # Fast parser of ASCII columns
+except ImportError:
+    print("Error importing python file seismogram_tools.py (see in utils/ directory), please make sure it is available/linked in this working directory...")
+    raise
 
 def representsInt(s):
     try:
@@ -69,17 +76,242 @@ def find_index(x,z,xil,zil):
     idxZ=np.searchsorted(zil,z)
     return idxX,idxZ
 
+def profileIndices(x0,z0,x1,z1,xil,zil,num):
+    """Return the (fractional) indices zLine,xLine in the 2D grid xil,zil of num points going from
+    the closest grid point of (x0,z0) to the closest grid point of (x1,z1). The ends can be arrays
+    (one value per profile), zLine and xLine have then the shape (number of profiles,num)"""
+    idxX0,idxZ0 = find_index(x0,z0,xil,zil)
+    idxX1,idxZ1 = find_index(x1,z1,xil,zil)
+    idxX0,idxZ0,idxX1,idxZ1 = np.broadcast_arrays(idxX0,idxZ0,idxX1,idxZ1)
+    t = np.linspace(0.0,1.0,num)
+    xLine = idxX0[...,np.newaxis] + (idxX1-idxX0)[...,np.newaxis]*t
+    zLine = idxZ0[...,np.newaxis] + (idxZ1-idxZ0)[...,np.newaxis]*t
+    return zLine,xLine
+
+def sampleField(array,zLine,xLine):
+    """Return the values of the 2D field array at the (fractional) indices zLine,xLine (arrays of any
+    shape, e.g. several profiles) using linear interpolation, in a single call to map_coordinates"""
+    zLine,xLine = np.broadcast_arrays(zLine,xLine)
+    if zLine.size and (zLine.min() < 0 or zLine.max() > array.shape[0]-1 or
+                       xLine.min() < 0 or xLine.max() > array.shape[1]-1):
+        raise ValueError("Profile out of the interpolated field: try to choose a lower z1 or a bigger z0!")
+    values = scipy.ndimage.map_coordinates(np.ma.filled(array),np.vstack((zLine.ravel(),xLine.ravel())),order=1)
+    return values.reshape(zLine.shape)
+
 def interpolateValue(array,xil,zil,x,z):
-    """Return the value of the 2D field described by array,xil and zil at (x,z)"""
+    """Return the value of the 2D field described by array,xil and zil at (x,z) (x and z can be arrays)"""
     idxX,idxZ = find_index(x,z,xil,zil)
-    xLine, zLine = np.array([idxX]), np.array([idxZ])
-    # Extract the values along the line, using cubic interpolation
-    if type(intEnergyi) == np.ndarray:
-        zi = scipy.ndimage.map_coordinates(array, np.vstack((zLine,xLine)),order=1)
+    return sampleField(array,idxZ,idxX)
+
+def readSlice(task):
+    """Read the columns x,z,energy of one slice (one file per proc) and write them directly
+    at their place in the memory-mapped array of all the points (called by worker processes)"""
+    path,pathToNpy,offset,nRows = task
+    data = read_ascii_columns(path)
+    if data.shape[0] != nRows:
+        raise ValueError("Unexpected number of rows in "+path+": "+str(data.shape[0])+" instead of "+str(nRows))
+    allData = np.load(pathToNpy,mmap_mode='r+')
+    allData[:,offset:offset+nRows] = data[:,:3].T
+    allData.flush()
+    del allData
+    return nRows
+
+def loadEnergyField(prefix,reset=False,jobs=1,noConcatenation=False,verbose=False):
+    """Return the arrays x,z,energy of all the points of the files prefix0* (the 0 is important:
+    it avoids reading prefix+"All", each proc has written its own file). The slices are read in
+    parallel by jobs processes directly into a preallocated binary file prefix+"All.npy" that is
+    memory-mapped (copy on write) and re-used by later runs unless reset is True or a slice
+    is newer. If noConcatenation is True (or if there is no slice) the single text file
+    prefix+"All" is read instead"""
+    slices = sorted(glob.glob(prefix+"0*"))
+    if noConcatenation or not slices:
+        slices = [prefix+"All"]
+    pathToNpy = prefix+"All.npy"
+    if (not os.path.isfile(pathToNpy) or reset or
+        max(os.path.getmtime(path) for path in slices) > os.path.getmtime(pathToNpy)):
+        if verbose:
+            print("Read "+str(len(slices))+" files "+prefix+"0* into "+pathToNpy+"...")
+        nRows = [count_ascii_rows(path)[0] for path in slices]
+        offsets = np.concatenate(([0],np.cumsum(nRows)[:-1]))
+        allData = np.lib.format.open_memmap(pathToNpy+".tmp",mode='w+',dtype=np.float64,shape=(3,sum(nRows)))
+        del allData # Create the file only, the workers fill it
+        tasks = [(path,pathToNpy+".tmp",int(offset),n) for path,offset,n in zip(slices,offsets,nRows)]
+        if jobs > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(processes=min(jobs,len(tasks)))
+            pool.map(readSlice,tasks)
+            pool.close()
+            pool.join()
+        else:
+            for task in tasks:
+                readSlice(task)
+        os.rename(pathToNpy+".tmp",pathToNpy) # (only complete files are re-used)
+        if verbose:
+            print("Done")
     else:
-        zi = scipy.ndimage.map_coordinates(array.filled(), np.vstack((zLine,xLine)),order=1)
-
-    return zi[0]
+        print(pathToNpy+" has been found!")
+    x,z,energy = np.load(pathToNpy,mmap_mode='c')
+    return x,z,energy
+
+def scaleEnergy(x,intEnergy,nameOfFiles,parFileDirectory,rgs=False,verbose=False):
+    """Return the energy multiplied by dt (for integrated energy files, dt is read in the Par_file) and by
+    the range x if rgs is True (to compensate geometrical spreading). Infinite values are set to the minimum"""
+    factorGs = 1.0 # Factor to compensate geometrical spreading if asked
+    if rgs: # Remove geometrical spreading
+        factorGs = x
+    if "integrated" in nameOfFiles: # We have to multiply by dt
+        if verbose:
+            print("Opening Par_file in ",parFileDirectory,"...")
+        par_file=ParFile(parFileDirectory+'Par_file') # Open and read the Par_file
+        intEnergy = intEnergy * par_file.dt * factorGs
+    if "max" in nameOfFiles:
+        intEnergy = intEnergy * factorGs
+    mask0=~np.isinf(intEnergy)
+    intEnergy[~mask0]=min(intEnergy[mask0])
+    return intEnergy
+
+def displayLimits(x,z,xlim=[],zlim=[]):
+    """Return the limits xmin,xmax,zmin,zmax of the plots (given by xlim and zlim or from the points)"""
+    if xlim:
+        xmin=float(xlim[0])
+        xmax=float(xlim[1])
+    else:
+        xmin=x.min()
+        xmax=0.98*x.max()
+    if zlim:
+        zmin=float(zlim[0])
+        zmax=float(zlim[1])
+    else:
+        zmin=z.min()+0.001*(z.max()-z.min())
+        zmax=z.max()-0.001*(z.max()-z.min())
+    return xmin,xmax,zmin,zmax
+
+def regularGrid(xmin,xmax,zmin,zmax,nx,nz):
+    """Return the coordinates xil,zil of the regular grid of nx x nz points used to interpolate the data"""
+    # Margins around the model
+    xmargin = (xmax - xmin) / 1000.0
+    zmargin = (zmax - zmin) / 1000.0
+    xil = np.linspace(xmin-xmargin, xmax+xmargin, nx)
+    zil = np.linspace(zmin-zmargin, zmax+zmargin, nz)
+    return xil,zil
+
+####################### BATCH MODE #######################
+# Energy maps of many runs rendered by a pool of processes without display (Agg backend)
+
+def runFiles(runDirectory,args):
+    """Return the prefix of the energy files, the Par_file directory and the cache directory of a run"""
+    runDirectory = os.path.join(runDirectory,"")
+    parFileDirectory = os.path.join(runDirectory,args.par_file_directory,"")
+    cacheDirectory = args.cache or runDirectory
+    return runDirectory+args.name_of_files,parFileDirectory,cacheDirectory
+
+def loadRun(task):
+    """Read the energy files of a run (into their .npy file) and return the hash of its coordinates
+    (called by worker processes)"""
+    runDirectory,args = task
+    from gridding_tools import coordinates_hash
+    prefix,parFileDirectory,cacheDirectory = runFiles(runDirectory,args)
+    try:
+        x,z,intEnergy = loadEnergyField(prefix,args.reset,1,args.no_concatenate_files)
+        return runDirectory,coordinates_hash(x,z),len(x),""
+    except Exception as e:
+        return runDirectory,"",0,str(e)
+
+def renderRun(task):
+    """Interpolate the energy of a run on the regular grid and save the map in a png file
+    (called by worker processes). Return the manifest entry of the run"""
+    runDirectory,args,pngFile = task
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fontsize = 14
+    startTime = time.time()
+    entry = {'directory': runDirectory, 'png': pngFile}
+    try:
+        prefix,parFileDirectory,cacheDirectory = runFiles(runDirectory,args)
+        x,z,intEnergy = loadEnergyField(prefix,False,1,args.no_concatenate_files)
+        intEnergy = scaleEnergy(x,intEnergy,args.name_of_files,parFileDirectory,args.rgs)
+        xmin,xmax,zmin,zmax = displayLimits(x,z,args.xlim,args.zlim)
+        xil,zil = regularGrid(xmin,xmax,zmin,zmax,args.nx,args.nz)
+        # The interpolator of the mesh has been built by the main process (shared by all the runs on this mesh)
+        interpolator = get_interpolator(x,z,cacheDirectory,ngll=args.ngll or None)
+        intEnergyi = np.ma.log10(interpolator.grid(intEnergy,xil,zil))
+        fig = Figure(figsize=(15,6))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        xi, zi = np.meshgrid(xil, zil)
+        im = ax.pcolormesh(xi,zi,intEnergyi,shading='gouraud',cmap=cm.BuPu)
+        if args.clim:
+            im.set_clim(float(args.clim[0]),float(args.clim[1]))
+        fig.colorbar(im,ax=ax)
+        ax.axis([xmin, xmax, zmin, zmax])
+        ax.set_title(args.title or runDirectory)
+        ax.set_xlabel("Range (m)",fontsize=fontsize+3)
+        ax.set_ylabel("Depth (m)",fontsize=fontsize+3)
+        fig.savefig(pngFile)
+        entry.update({'mesh': interpolator.key, 'points': len(x),
+                      'min': float(intEnergyi.min()), 'max': float(intEnergyi.max())})
+    except Exception as e:
+        entry['error'] = str(e)
+    entry['seconds'] = time.time()-startTime
+    return entry
+
+def renderBatch(args):
+    """Render the energy maps of all the run directories given by args.batch (directories or glob patterns)
+    into args.output_directory and write the manifest (json) of the maps. Return 1 if a run failed"""
+    runDirectories = []
+    for pattern in args.batch:
+        runDirectories += sorted(d for d in glob.glob(pattern) if os.path.isdir(d))
+    if not runDirectories:
+        print("No run directories were found!")
+        return 1
+    if not os.path.isdir(args.output_directory):
+        os.makedirs(args.output_directory)
+    jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+    print("Rendering "+str(len(runDirectories))+" runs with "+str(jobs)+" processes...")
+    pool = multiprocessing.Pool(processes=jobs)
+    loaded = pool.map(loadRun,[(runDirectory,args) for runDirectory in runDirectories])
+    pool.close()
+    pool.join()
+
+    # One interpolator (triangulation and weights) per mesh, built before starting the rendering
+    # processes that inherit it. Runs on the same mesh have the same grid
+    entries = []
+    tasks = []
+    meshes = {}
+    for runDirectory,key,nPoints,error in loaded:
+        if error:
+            print("Error reading "+runDirectory+": "+error)
+            entries.append({'directory': runDirectory, 'error': error})
+            continue
+        if key not in meshes:
+            prefix,parFileDirectory,cacheDirectory = runFiles(runDirectory,args)
+            x,z,intEnergy = np.load(prefix+"All.npy",mmap_mode='r')
+            if args.verbose:
+                print("Mesh "+key+" ("+str(nPoints)+" points) of "+runDirectory)
+            xil,zil = regularGrid(*displayLimits(x,z,args.xlim,args.zlim),nx=args.nx,nz=args.nz)
+            get_interpolator(x,z,cacheDirectory,args.verbose,args.ngll or None).weights(xil,zil)
+            meshes[key] = runDirectory
+        name = os.path.normpath(runDirectory).strip(os.sep).replace(os.sep,"_").replace(".","_")
+        tasks.append((runDirectory,args,os.path.join(args.output_directory,name+"_"+args.name_of_files+".png")))
+
+    pool = multiprocessing.Pool(processes=jobs)
+    for entry in pool.imap(renderRun,tasks):
+        if 'error' in entry:
+            print("Error rendering "+entry['directory']+": "+entry['error'])
+        elif args.verbose:
+            print("  "+entry['png']+" ("+"%.2f" % entry['seconds']+" s)")
+        entries.append(entry)
+    pool.close()
+    pool.join()
+
+    entries.sort(key=lambda entry: entry['directory'])
+    manifest = {'name_of_files': args.name_of_files, 'nx': args.nx, 'nz': args.nz,
+                'meshes': len(meshes), 'runs': entries}
+    manifestFile = os.path.join(args.output_directory,args.manifest)
+    with open(manifestFile,'w') as f:
+        json.dump(manifest,f,indent=2,sort_keys=True,separators=(',', ': '))
+    print("File "+manifestFile+" has been written ("+str(len(meshes))+" meshes, "+
+          str(sum('error' not in entry for entry in entries))+" maps)")
+    return int(any('error' in entry for entry in entries))
 
 ####################### PARSE ARGUMENTS #######################
 # Here we read the argument given and we check them
@@ -95,7 +327,9 @@ parser.add_argument("--name_of_files","-n",type=str,default="total_integrated_en
 parser.add_argument('-p','--profiles', action='store_true',
     help='profiles: calculate energy profiles')
 parser.add_argument('-nc','--no_concatenate_files', action='store_true',
-    help='no_concatenate_files: don t concatenate files at the beginning of the script')
+    help='no_concatenate_files: don t concatenate files at the beginning of the script (read the file name_of_filesAll)')
+parser.add_argument('-j','--jobs',type=int,default=0,
+    help='jobs: number of processes reading the files of the procs (default: 0, all the cores)')
 parser.add_argument('-nl','--nolog', action='store_true',
     help='nolog: no apply log')
 parser.add_argument("--title","-t",type=str,default="",
@@ -130,12 +364,31 @@ parser.add_argument("--substract","-s",type=str,default="",
     help="substract : substract the field with the field given here")
 parser.add_argument('-r','--reset', action='store_true',
     help='reset: delete all field previously built')
+parser.add_argument("--cache",type=str,default="",
+    help="cache: directory where the triangulations of the meshes are stored. Default: the directory of the files")
+parser.add_argument("--ngll",type=int,default=0,
+    help="ngll: the files contain the ngll x ngll GLL points of each spectral element, written element by element: \
+          interpolate within the elements, without Delaunay triangulation. Default: 0 (Delaunay). \
+          The energy fields written by the solver have one point per element and need Delaunay")
+parser.add_argument("--batch",type=str,nargs='+',default=[],
+    help="batch: render without display the energy maps of all the run directories given (or glob patterns, \
+          e.g. 'runs/*/OUTPUT_FILES'). --par_file_directory is then relative to each run directory")
+parser.add_argument("--output_directory","-o",type=str,default="./",
+    help="output_directory: directory where the maps are written in batch mode")
+parser.add_argument("--manifest",type=str,default="manifest.json",
+    help="manifest: name of the file listing the maps written in batch mode (in output_directory)")
 parser.add_argument('-v','--verbose', action='store_true',
     help='verbose: display more information')
 
 args = parser.parse_args()
 directory=args.input_directory
 
+if args.batch:
+    matplotlib.use('Agg') # No display needed
+    sys.exit(renderBatch(args))
+
+import matplotlib.pyplot as plt # (After the batch mode, which must not load an interactive backend)
+
 fontsize = 14
 zminProfiles = -10000
 zmaxProfiles = -100 #-200 # TODO (-650m for 0.5Hz, -300m for 2Hz...)
@@ -164,51 +417,23 @@ if not glob.glob(directory+args.name_of_files+"*"): # If we don't find any match
     print("No files "+directory+args.name_of_files+"* were found!")
     sys.exit(0)
 
-# Concatenate all the files (if specfem has been run on parallel each proc has created its own files)
-
-if not os.path.isfile(directory+args.name_of_files+"All") or args.reset: # If the concatenation has not already been done
-    if args.verbose:
-        print("Concatenate files...")
-    if not args.no_concatenate_files:
-        with open(directory+args.name_of_files+"All", 'w') as outfile:
-            for infile in glob.glob(directory+args.name_of_files+"0*"): # !!Warning!! The 0 is important!! Otherwise infinite loop
-                shutil.copyfileobj(open(infile), outfile)
-else:
-    print(directory+args.name_of_files+"All has been found!")
-
 #### OPTION SUBSTRACT ####
 if args.substract:
     if not glob.glob(args.substract+"*"): # If we don't find any matching energy file...
         print("No files "+args.substract+"* were found!")
         sys.exit(0)
-    # Concatenate all the files (if specfem has been run on parallel each proc has created its own files)
-
-    if not os.path.isfile(args.substract+"All") or args.reset: # If the concatenation has not already been done
-        if args.verbose:
-            print("Concatenate files of substracted field...")
-        if not args.no_concatenate_files:
-            with open(args.substract+"All", 'w') as outfile:
-                for infile in glob.glob(args.substract+"0*"): # !!Warning!! The 0 is important!! Otherwise infinite loop
-                    shutil.copyfileobj(open(infile), outfile)
-    else:
-        print(args.substract+"All has been found!")
-
 ##########################
 
-if args.verbose:
-    print("Done")
 plt.close('all')
 
-# Load data
-if args.verbose:
-    print("Load data in "+directory+args.name_of_files+"All")
-x,z,intEnergy = np.loadtxt(directory+args.name_of_files+"All").T
+jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+
+# Load data (if specfem has been run on parallel each proc has created its own files)
+x,z,intEnergy = loadEnergyField(directory+args.name_of_files,args.reset,jobs,args.no_concatenate_files,args.verbose)
 
 #### OPTION SUBSTRACT ####
 if args.substract:
-    if args.verbose:
-        print("Load data in "+args.substract+"All")
-    xSubstract,zSubstract,intEnergySubstract = np.loadtxt(args.substract+"All").T
+    xSubstract,zSubstract,intEnergySubstract = loadEnergyField(args.substract,args.reset,jobs,args.no_concatenate_files,args.verbose)
 ##########################
 
 #if args.verbose:
@@ -218,35 +443,10 @@ if args.substract:
 if args.verbose:
     print("Done")
 
-factorGs = 1.0 # Factor to compensate geometrical spreading if asked
-factorGsSubstract = 1.0 # Factor to compensate geometrical spreading if asked
-if args.rgs: # Remove geometrical spreading
-    factorGs = x
-    if args.substract:
-        factorGsSubstract = xSubstract
-
-if "integrated" in args.name_of_files: # We have to multiply by dt
-    #scalingFactor = (vx0**2+vz0**2).sum()
-    if args.verbose:
-        print("Opening Par_file in ",par_file_directory,"...")
-    par_file=ParFile(par_file_directory+'Par_file') # Open and read the Par_file
-    intEnergy = intEnergy * par_file.dt * factorGs
-    #intEnergy = intEnergy/scalingFactor
-    if args.substract:
-        intEnergySubstract = intEnergySubstract * par_file.dt * factorGsSubstract
-
-if "max" in args.name_of_files:
-    #scalingFactor = (vx0**2+vz0**2).max()
-    intEnergy = intEnergy * factorGs
-    #intEnergy = intEnergy/scalingFactor
-    if args.substract:
-        intEnergySubstract = intEnergySubstract * factorGsSubstract
-
-mask0=~np.isinf(intEnergy)
-intEnergy[~mask0]=min(intEnergy[mask0])
+# Multiply by dt (integrated energy) and compensate geometrical spreading if asked
+intEnergy = scaleEnergy(x,intEnergy,args.name_of_files,par_file_directory,args.rgs,args.verbose)
 if args.substract:
-    mask0substract=~np.isinf(intEnergySubstract)
-    intEnergySubstract[~mask0substract]=min(intEnergySubstract[mask0substract])
+    intEnergySubstract = scaleEnergy(xSubstract,intEnergySubstract,args.name_of_files,par_file_directory,args.rgs)
 
 nxProfiles = int(args.nxnzProfiles[0])
 nzProfiles = int(args.nxnzProfiles[1])
@@ -259,19 +459,7 @@ if args.clim:
     climMax = float(args.clim[1])
 
 # Display limits:
-if args.xlim:
-    xmin=float(args.xlim[0])
-    xmax=float(args.xlim[1])
-else:
-    xmin=x.min()
-    xmax=0.98*x.max()
-
-if args.zlim:
-    zmin=float(args.zlim[0])
-    zmax=float(args.zlim[1])
-else:
-    zmin=z.min()+0.001*(z.max()-z.min())
-    zmax=z.max()-0.001*(z.max()-z.min())
+xmin,xmax,zmin,zmax = displayLimits(x,z,args.xlim,args.zlim)
 #print("zmin:",zmin,"zmax:",zmax)
 
 if args.displayPoints:
@@ -300,31 +488,43 @@ if args.quickDisplay: # Quick ways to plot the energy using the non homogeneous
 # Size of regular grid
 nx, nz = args.nx,args.nz
 
-# Margins around the model
-xmargin = (xmax - xmin) / 1000.0
-zmargin = (zmax - zmin) / 1000.0
-
-# Generate a regular grid to interpolate the data.
-xil = np.linspace(xmin-xmargin, xmax+xmargin, nx)
-zil = np.linspace(zmin-zmargin, zmax+zmargin, nz)
+# Generate a regular grid to interpolate the data (with margins around the model).
+xil, zil = regularGrid(xmin,xmax,zmin,zmax,nx,nz)
 xi, zi = np.meshgrid(xil, zil)
 
+if args.cache:
+    cacheDirectory = args.cache
+else:
+    cacheDirectory = os.path.dirname(directory+args.name_of_files) or "."
+
 #print("TODO max zil:",zil.max(),"  min zil:",zil.min())
 
-if os.path.isfile(directory+args.name_of_files+"AllInterpolatedx"+str(nx)+"z"+str(nz)) and not args.reset: # If the interpolation has already been done and written
+#### OPTION SUBSTRACT ####
+sameMesh = False
+if args.substract:
+    pointsSubstract = align_points(x,z,xSubstract,zSubstract)
+    sameMesh = pointsSubstract is not None
+    if sameMesh: # Both fields on the same points: substract them before the (single) interpolation
+        if args.verbose:
+            print("Same mesh for both fields, substracting the values at the points...")
+        intEnergy = intEnergy - intEnergySubstract[pointsSubstract]
+##########################
+
+if os.path.isfile(directory+args.name_of_files+"AllInterpolatedx"+str(nx)+"z"+str(nz)) and not args.reset and not sameMesh: # If the interpolation has already been done and written
     if args.verbose:
         print("Interpolated field file has been found. Loading...")
     intEnergyi = np.load(directory+args.name_of_files+"AllInterpolatedx"+str(nx)+"z"+str(nz))
     if args.verbose:
         print("Done")
 else:
-    # Interpolate using delaunay triangularization:
+    # Interpolate using delaunay triangularization (built once per mesh, stored in cache directory)
+    # or the spectral elements if the files contain their GLL points (--ngll):
     if args.verbose:
         print("Interpolation...")
-    intEnergyi = mlab.griddata(x,z,intEnergy,xi,zi,interp="linear")
+    intEnergyi = get_interpolator(x,z,cacheDirectory,args.verbose,args.ngll or None).grid(intEnergy,xil,zil)
     if args.verbose:
         print("Done")
-    if args.writeInterpolatedField:
+    if args.writeInterpolatedField and not sameMesh:
         if args.verbose:
             print("Writing the interpolated field to file..."+directory+args.name_of_files+"AllInterpolatedx"+str(nx)+"z"+str(nz))
         intEnergyi.dump(directory+args.name_of_files+"AllInterpolatedx"+str(nx)+"z"+str(nz))
@@ -333,7 +533,9 @@ else:
 
 #### OPTION SUBSTRACT ####
 
-if args.substract:
+if sameMesh: # The difference has been interpolated
+    intEnergyi = abs(intEnergyi)
+elif args.substract: # Different meshes: both fields are interpolated on the grid
     if os.path.isfile(args.substract+"AllInterpolatedx"+str(nx)+"z"+str(nz)) and not args.reset: # If the interpolation has already been done and written
         if args.verbose:
             print("Interpolated substracted field file has been found. Loading...")
@@ -341,10 +543,10 @@ if args.substract:
         if args.verbose:
             print("Done")
     else:
-        # Interpolate using delaunay triangularization:
+        # Interpolate using delaunay triangularization of the other mesh (built once, stored in cache directory):
         if args.verbose:
             print("Interpolation of substracted file...")
-        intEnergyiSubstract = mlab.griddata(xSubstract,zSubstract,intEnergySubstract,xi,zi,interp="linear")
+        intEnergyiSubstract = get_interpolator(xSubstract,zSubstract,cacheDirectory,args.verbose,args.ngll or None).grid(intEnergySubstract,xil,zil)
         if args.verbose:
             print("Done")
         if args.writeInterpolatedField:
@@ -408,26 +610,20 @@ if args.profiles:
     colors = [cmap2(i) for i in np.linspace(0, 1, len(zVector))] # Color vector
     xvect=np.linspace(xmin,xmax,num) # x vector
 
+    # Extract the values along all the horizontal lines at once, using linear interpolation
+    zLines, xLines = profileIndices(xmin,zVector,xmax,zVector,xil,zil,num) # indices in the 2D grid
+    horizontalProfiles = sampleField(intEnergyi,zLines,xLines)
+
     for i,zz in enumerate(zVector): # loop on the depths, plot all horizontal profiles in a figure (figure 2)
         x0,z0=xmin,zz
         x1,z1=xmax,zz
 
-        idxX0,idxZ0 = find_index(x0,z0,xil,zil) # indices of the closest point in the 2D grid
-        idxX1,idxZ1 = find_index(x1,z1,xil,zil) # indices of the closest point in the 2D grid
         if not args.noplot and nzProfiles > 1:
             plt.figure(1)
             plt.hold(True)
-        xLine, zLine = np.linspace(idxX0,idxX1, num), np.linspace(idxZ0, idxZ1, num) # vector containing the indices
         if args.verbose:
             print("Profile 1 to be saved: (x0,z0) = (",x0,",",z0,")   (x1,z1) = (",x1,",",z1,")")
-        #print("xmin:",xmin,"xmax:",xmax,"zz:",zz)
-        zi = intEnergyi[zLine.astype(np.int),xLine.astype(np.int)] # If you have got an error here try to choose a lower z1 or a bigger z0! 1
-
-        # Extract the values along the line, using cubic interpolation
-        if type(intEnergyi) == np.ndarray:
-            zi = scipy.ndimage.map_coordinates(intEnergyi, np.vstack((zLine,xLine)),order=1)
-        else:
-            zi = scipy.ndimage.map_coordinates(intEnergyi.filled(), np.vstack((zLine,xLine)),order=1)
+        zi = horizontalProfiles[i]
         if not args.noplot and nzProfiles > 1:
             plt.plot([x0, x1], [z0, z1], 'o-',color=colors[i])
             plt.figure(2)
@@ -449,37 +645,26 @@ if args.profiles:
     z0=zminProfiles
     z1=zmaxProfiles # Be careful! This point can't be too close to zmax!
     zvect=np.linspace(z0,z1,num)
-    depthIntegratedEnergy=np.zeros(len(xVector))
     #depthIntegratedEnergy2=np.zeros(len(xVector))
 
+    # Extract the values along all the vertical lines at once, using linear interpolation
+    zLines, xLines = profileIndices(xVector,z0,xVector,z1,xil,zil,num) # indices in the 2D grid
+    verticalProfiles = sampleField(intEnergyi,zLines,xLines)
+    if not args.nolog:
+        depthIntegratedEnergy=10*np.log10(np.power(10,verticalProfiles/10.0).sum(axis=-1))
+    else:
+        depthIntegratedEnergy=np.power(10,verticalProfiles/10.0).sum(axis=-1)
+
     for i,xx in enumerate(xVector): # Loop on the ranges, plot all vertical profiles in a figure.
         x0=xx
         x1=xx
 
-        idxX0,idxZ0 = find_index(x0,z0,xil,zil) # indices of the closest point in the 2D grid
-        idxX1,idxZ1 = find_index(x1,z1,xil,zil) # indices of the closest point in the 2D grid
         if not args.noplot and nxProfiles > 1:
             plt.figure(1)
             plt.hold(True)
         if args.verbose:
             print("Profile 2 to be saved: (x0,z0) = (",x0,",",z0,")   (x1,z1) = (",x1,",",z1,")")
-        xLine, zLine = np.linspace(idxX0,idxX1, num), np.linspace(idxZ0, idxZ1, num)
-        #print("xx:",xmin,"xil:",xil,"zil:",zil)
-        zi = intEnergyi[zLine.astype(np.int),xLine.astype(np.int)] # If you have got an error here try to choose a lower z1 or a bigger z0! 2
-
-
-        # Extract the values along the line, using cubic interpolation
-        if type(intEnergyi) == np.ndarray:
-            zi = scipy.ndimage.interpolation.map_coordinates(intEnergyi, np.vstack((zLine,xLine)),order=1)
-        else:
-             zi = scipy.ndimage.interpolation.map_coordinates(intEnergyi.filled(), np.vstack((zLine,xLine)),order=1)
-        #depthIntegratedEnergy[i]=zi2.sum()
-        #depthIntegratedEnergy2[i]=zi.sum()
-
-        if not args.nolog:
-            depthIntegratedEnergy[i]=10*np.log10(np.power(10,zi/10.0).sum())
-        else:
-            depthIntegratedEnergy[i]=np.power(10,zi/10.0).sum()
+        zi = verticalProfiles[i]
         if not args.noplot and nxProfiles > 1:
             plt.plot([x0, x1], [z0, z1], 'o-',color=colors[i])
             plt.figure(3)
@@ -536,12 +721,10 @@ if args.saveOneProfile:
         sys.exit("Tilted profiles are not handled for now!")
     if args.verbose:
         print("Profile to be saved: (x0,z0) = (",x0,",",z0,")   (x1,z1) = (",x1,",",z1,")")
-    idxX0,idxZ0 = find_index(x0,z0,xil,zil)
-    idxX1,idxZ1 = find_index(x1,z1,xil,zil)
     if not args.noplot:
         plt.figure(1)
         plt.hold(True)
-    xLine, zLine = np.linspace(idxX0,idxX1, num), np.linspace(idxZ0, idxZ1, num)
+    zLine, xLine = profileIndices(x0,z0,x1,z1,xil,zil,num)
     # Extract the values along the line, using cubic interpolation
 
     zi1 = intEnergyi[zLine.astype(np.int),xLine.astype(np.int)] # If you have got an error here try to choose a lower z1 or a bigger z0! 3
@@ -552,10 +735,10 @@ if args.saveOneProfile:
     else:
         #zi2 = scipy.ndimage.map_coordinates(np.transpose(intEnergyi).filled(), np.vstack((xLine,zLine)),order=1)
         sp = interpolate.RectBivariateSpline(zil,xil,intEnergyi, kx=3, ky=3, s=7)
-    if x0 == x1:
-        zi = [float(sp([vect[i]],[x0])) for i in range(num)]
+    if x0 == x1: # (all the points evaluated in one call)
+        zi = sp.ev(vect,np.full(num,x0))
     if z0 == z1:
-        zi = [float(sp([z0],[vect[i]])) for i in range(num)]
+        zi = sp.ev(np.full(num,z0),vect)
     #print(zi2,sp([140000.0],[-2000]),sp([140000.0],[-2500]))
     #depthIntegratedEnergy2[i]=zi.sum()
     #if not args.nolog:
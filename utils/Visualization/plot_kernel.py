@@ -11,65 +11,90 @@ except:
     sys.tracebacklimit=0
     raise Exception("Importing matplotlib failed")
 
-def grid(x, y, z, resX=100, resY=100):
+try:
+    from gridding_tools import get_interpolator
+except:
+    print("Error importing gridding_tools.py (in utils/Visualization/ directory), please install scipy package first...")
+    sys.tracebacklimit=0
+    raise Exception("Importing gridding_tools failed")
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir)) # seismogram_tools.py is in utils/
+try:
+    from seismogram_tools import count_ascii_rows, read_ascii_column_blocks
+except:
+    print("Error importing python file seismogram_tools.py (see in utils/ directory), please make sure it is available/linked in this working directory...")
+    sys.tracebacklimit=0
+    raise Exception("Importing seismogram_tools.py failed")
+
+# default resolution of the kernel images
+RES_X = 100
+RES_Y = 100
+
+def grid(x, y, z, resX=RES_X, resY=RES_Y, cache_dir=None, ngll=None):
     """
     Converts 3 column data to matplotlib grid
-    """
-    from matplotlib.mlab import griddata
-    #from scipy.interpolate import griddata
 
-    xi = np.linspace(min(x), max(x), resX)
-    yi = np.linspace(min(y), max(y), resY)
+    the triangulation of the points (x,y) is built once and shared by all the kernels
+    on the same points (stored in cache_dir if given); with ngll given, the triangles come
+    from the ngll x ngll GLL points of each element (no Delaunay triangulation)
+
+    z can hold several kernels (points x kernels): all get interpolated in a single pass
+    with the same weights, Z has then the shape (kernels, resY, resX)
+    """
+    xi = np.linspace(x.min(), x.max(), resX)
+    yi = np.linspace(y.min(), y.max(), resY)
 
-    # mlab version
-    Z = griddata(x, y, z, xi, yi, interp='linear')
-    # scipy version
-    #Z = griddata((x, y), z, (xi[None,:], yi[:,None]), method='cubic')
+    # linear interpolation, same as matplotlib.mlab.griddata(x, y, z, xi, yi, interp='linear')
+    Z = get_interpolator(x, y, cache_dir, ngll=ngll).grid(z, xi, yi)
 
     X, Y = np.meshgrid(xi, yi)
     return X, Y, Z
 
-def plot_kernels(filename,show=False):
+def plot_kernels(filename,show=False,ngll=None,resX=RES_X,resY=RES_Y,cache_dir=None):
     """
     plots ASCII kernel file
+
+    the triangulation of the kernel points is stored in cache_dir if given (no on-disk cache otherwise)
     """
     print "plotting kernel file: ",filename
     print ""
 
-    data = np.loadtxt(filename)
+    nrows,ncols = count_ascii_rows(filename)
 
     # checks data
-    if data.ndim != 2:
-        print "Error: wrong data dimension for kernel file",data.ndim
+    if nrows < 2:
+        print "Error: wrong data dimension for kernel file",nrows
         sys.tracebacklimit=0
         raise Exception("Invalid data dimension")
 
     # checks array
-    if len(data[1,:]) != 5:
-        print "data shape  : ",data.shape
-        print "data lengths: ",len(data[:,1]),len(data[1,:])
-        print "Error: wrong data format for kernel file",data.shape
+    if ncols != 5:
+        print "data shape  : ",(nrows,ncols)
+        print "data lengths: ",nrows,ncols
+        print "Error: wrong data format for kernel file",(nrows,ncols)
         sys.tracebacklimit=0
         raise Exception("Invalid data format")
 
+    # reads in columns (single precision), with min/max of each column
+    data, data_min, data_max = read_ascii_column_blocks(filename, usecols=(0,1,2,3,4), dtype=np.float32)
+
     # splits up data
-    x = data[:,0]
-    y = data[:,1]
+    x = data[0]
+    y = data[1]
 
     print "dimensions:"
-    print "  x-range min/max = %f / %f" % (x.min(), x.max())
-    print "  y-range min/max = %f / %f" % (y.min(), y.max())
+    print "  x-range min/max = %f / %f" % (data_min[0], data_max[0])
+    print "  y-range min/max = %f / %f" % (data_min[1], data_max[1])
     print ""
 
-    z1 = data[:,2] # e.g. rho
-    z2 = data[:,3] # e.g. alpha
-    z3 = data[:,4] # e.g. beta
+    # kernels, e.g. rho, alpha, beta
+    kernels = data[2:5]
 
     # names like
     #   rhop_alpha_beta_kernel.dat
     # or
     #   proc000000_rhop_alpha_beta_kernel.dat
-    name = os.path.basename(file)
+    name = os.path.basename(filename)
 
     name_kernels = str.split(name,"_")
     if len(name_kernels) == 4:
@@ -86,38 +111,38 @@ def plot_kernels(filename,show=False):
         kernel3 = 'K_3'
 
     print "statistics:"
-    print "  %12s : min/max = %e / %e" % (kernel1,z1.min(),z1.max())
-    print "  %12s : min/max = %e / %e" % (kernel2,z2.min(),z2.max())
-    print "  %12s : min/max = %e / %e" % (kernel3,z3.min(),z3.max())
+    print "  %12s : min/max = %e / %e" % (kernel1,data_min[2],data_max[2])
+    print "  %12s : min/max = %e / %e" % (kernel2,data_min[3],data_max[3])
+    print "  %12s : min/max = %e / %e" % (kernel3,data_min[4],data_max[4])
     print ""
 
-    total_max = abs(np.concatenate((z1,z2,z3))).max()
+    total_max = max(abs(data_min[2:5]).max(), abs(data_max[2:5]).max())
     print "  data max = ",total_max
     print ""
 
     total_max = 1.e-8
 
+    # interpolates the 3 kernels at once
+    X, Y, Z = grid(x,y,kernels.T,resX,resY,cache_dir=cache_dir,ngll=ngll)
+
     # setup figure (with 3 subplots)
     fig, axes = plt.subplots(nrows=3, ncols=1)
 
     for i,ax in enumerate(axes.flat,start=1):
         # top
         if i == 1:
-            X, Y, Z = grid(x,y,z1)
             ax.set_title("Kernels")
             ax.set_ylabel(kernel1)
         elif i == 2:
-            X, Y, Z = grid(x,y,z2)
             ax.set_ylabel(kernel2)
         elif i == 3:
-            X, Y, Z = grid(x,y,z3)
             ax.set_ylabel(kernel3)
 
         #colormap = 'jet'
         colormap = 'RdBu'
 
-        im = ax.imshow(Z,vmax=total_max, vmin=-total_max,
-                       extent=[x.min(), x.max(), y.min(), y.max()],cmap=colormap)
+        im = ax.imshow(Z[i-1],vmax=total_max, vmin=-total_max,
+                       extent=[data_min[0], data_max[0], data_min[1], data_max[1]],cmap=colormap)
 
     # moves plots together
     fig.subplots_adjust(hspace=0)
@@ -132,7 +157,7 @@ def plot_kernels(filename,show=False):
         plt.show()
 
     # saves kernel figure as file
-    dir = os.path.dirname(file)
+    dir = os.path.dirname(filename) or "."
     name_without_ending = str.split(name,".")[0]
     outfile = dir + "/" + name_without_ending + ".png"
     fig.savefig(outfile, format="png")
@@ -144,25 +169,58 @@ def plot_kernels(filename,show=False):
 
 
 def usage():
-    print "usage: ./plot_kernel.py file [1 == show figure / 0 == just plot file]"
+    print "usage: ./plot_kernel.py [--ngll N] [--res NX NY] [--cache DIR] file [1 == show figure / 0 == just plot file]"
     print "   where"
-    print "       file - ASCII kernel file, e.g. OUTPUT_FILES/proc000000_rhop_alpha_beta_kernel.dat"
+    print "       file     - ASCII kernel file, e.g. OUTPUT_FILES/proc000000_rhop_alpha_beta_kernel.dat"
+    print "       --ngll N - (optional) interpolates within the spectral elements, the file holding"
+    print "                  the N x N GLL points of each element (N = NGLLX, e.g. 5), instead of"
+    print "                  using a Delaunay triangulation (much faster for large kernels)"
+    print "       --res NX NY - (optional) resolution of the kernel images (default: %d x %d)" % (RES_X,RES_Y)
+    print "       --cache DIR - (optional) directory where the triangulations of the kernel points are stored"
+    print "                     and re-used by later plots of the same mesh (default: no cache)"
 
 if __name__ == '__main__':
     # gets arguments
-    if len(sys.argv) < 2:
+    ngll = None
+    resX = RES_X
+    resY = RES_Y
+    cache_dir = None
+    params = []
+    args = sys.argv[1:]
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == '--ngll':
+            if len(args) == 0:
+                usage()
+                sys.exit(1)
+            ngll = int(args.pop(0))
+        elif arg == '--res':
+            if len(args) < 2:
+                usage()
+                sys.exit(1)
+            resX = int(args.pop(0))
+            resY = int(args.pop(0))
+        elif arg == '--cache':
+            if len(args) == 0:
+                usage()
+                sys.exit(1)
+            cache_dir = args.pop(0)
+        else:
+            params.append(arg)
+
+    if len(params) < 1:
         usage()
         sys.exit(1)
     else:
-        file = sys.argv[1]
+        file = params[0]
 
-    if len(sys.argv) > 2:
-        show_plot = sys.argv[2]
+    if len(params) > 1:
+        show_plot = params[1]
     else:
         show_plot = 0
 
     if show_plot == '1':
-        plot_kernels(file,show=True)
+        plot_kernels(file,show=True,ngll=ngll,resX=resX,resY=resY,cache_dir=cache_dir)
     else:
-        plot_kernels(file)
+        plot_kernels(file,ngll=ngll,resX=resX,resY=resY,cache_dir=cache_dir)
 
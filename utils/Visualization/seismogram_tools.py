@@ -0,0 +1 @@
+../seismogram_tools.py
\ No newline at end of file
@@ -5,12 +5,503 @@
 import sys
 import glob
 import os
+import itertools
+import multiprocessing
 import numpy as np
 
+try:
+    from seismogram_tools import read_ascii_columns
+except:
+    print("Error importing python file seismogram_tools.py (see in utils/ directory), please make sure it is available/linked in this working directory...")
+    sys.tracebacklimit=0
+    raise Exception("Importing seismogram_tools.py failed")
+
 # tolerance values
 TOL_CORR = 0.8
 TOL_ERR = 0.01
 
+# tolerance for matching point coordinates (relative to the domain size),
+# kernel files store coordinates with 5 significant digits
+TOL_COORD = 1.e-5
+
+def read_kernel_file(filename):
+    """
+    reads in an ASCII kernel file in a single pass
+
+    data format: e.g. #x-coord #y-coord #rhop #alpha #beta
+    returns the data as 2D array (points x columns)
+    """
+    return read_ascii_columns(filename)
+
+
+def coordinate_tolerance(ref_xz,syn_xz):
+    """
+    returns the absolute tolerance for matching point coordinates
+    """
+    xz_min = np.minimum(ref_xz.min(axis=0), syn_xz.min(axis=0))
+    xz_max = np.maximum(ref_xz.max(axis=0), syn_xz.max(axis=0))
+    extent = np.max(xz_max - xz_min)
+    if extent <= 0.0: extent = max(np.max(np.abs(xz_max)), 1.0)
+    return TOL_COORD * extent
+
+
+def match_points(ref_xz,syn_xz):
+    """
+    finds the reference point for each output point by its x/z coordinates
+
+    uses a sorted spatial hash: coordinates are binned into cells of the matching tolerance,
+    the sorted cell keys of the reference points are searched for the keys of the output points (O(N log N));
+    all reference points of the cell and of its neighboring cells within the tolerance are candidates.
+    the matching is one-to-one: each output point gets its closest free candidate,
+    points listed several times (e.g. on element edges) are paired by their order of appearance in each file.
+    returns the index of the matching reference point for each output point (-1 if there is none)
+    """
+    ref_xz = np.asarray(ref_xz, dtype=np.float64)
+    syn_xz = np.asarray(syn_xz, dtype=np.float64)
+
+    tol = coordinate_tolerance(ref_xz, syn_xz)
+    xz_min = np.minimum(ref_xz.min(axis=0), syn_xz.min(axis=0))
+
+    # cell indices (with a layer of empty cells around for the neighbor search)
+    ref_cells = np.floor((ref_xz - xz_min) / tol).astype(np.int64) + 1
+    syn_cells = np.floor((syn_xz - xz_min) / tol).astype(np.int64) + 1
+    nz = max(ref_cells[:,1].max(), syn_cells[:,1].max()) + 2
+
+    ref_keys = ref_cells[:,0] * nz + ref_cells[:,1]
+    syn_keys = syn_cells[:,0] * nz + syn_cells[:,1]
+
+    # sorted reference keys (stable sort keeps duplicate points in order of appearance)
+    ref_order = np.argsort(ref_keys, kind='mergesort')
+    ref_sorted = ref_keys[ref_order]
+
+    # candidate pairs (output point, reference point) in the same and in the neighboring cells
+    pair_syn = []
+    pair_ref = []
+    for dx in (-1, 0, 1):
+        for dz in (-1, 0, 1):
+            keys = syn_keys + dx * nz + dz
+            first = np.searchsorted(ref_sorted, keys, side='left')
+            count = np.searchsorted(ref_sorted, keys, side='right') - first
+            isyn = np.repeat(np.arange(len(syn_keys)), count)
+            # position of each candidate in the sorted reference keys
+            offset = np.arange(len(isyn)) - np.repeat(np.cumsum(count) - count, count)
+            iref = ref_order[np.repeat(first, count) + offset]
+            close = np.all(np.abs(ref_xz[iref] - syn_xz[isyn]) <= tol, axis=1)
+            pair_syn.append(isyn[close])
+            pair_ref.append(iref[close])
+    pair_syn = np.concatenate(pair_syn)
+    pair_ref = np.concatenate(pair_ref)
+    pair_dist = np.sum((ref_xz[pair_ref] - syn_xz[pair_syn])**2, axis=1)
+
+    # one-to-one assignment: each output point proposes its closest candidate (first in file order on ties),
+    # each reference point accepts the closest proposal (first in file order on ties);
+    # repeated with the remaining free points until no candidate pair is left
+    index = -np.ones(len(syn_keys), dtype=np.int64)
+    ref_used = np.zeros(len(ref_keys), dtype=bool)
+    while len(pair_syn) > 0:
+        order = np.lexsort((pair_ref, pair_dist, pair_syn))
+        best = order[np.r_[True, pair_syn[order][1:] != pair_syn[order][:-1]]]
+        s, r, d = pair_syn[best], pair_ref[best], pair_dist[best]
+        order = np.lexsort((s, d, r))
+        accept = order[np.r_[True, r[order][1:] != r[order][:-1]]]
+        index[s[accept]] = r[accept]
+        ref_used[r[accept]] = True
+
+        free = (index[pair_syn] < 0) & ~ref_used[pair_ref]
+        pair_syn = pair_syn[free]
+        pair_ref = pair_ref[free]
+        pair_dist = pair_dist[free]
+
+    return index
+
+
+def align_kernel_points(ref_data,syn_data):
+    """
+    aligns the points of reference and output kernel data (points x columns, starting with x/z coordinates)
+
+    if the point order differs, e.g. for a different number of slices, the output points get matched
+    to the reference points by their coordinates; every output and every reference point must find its match,
+    otherwise the files are considered as mismatching and empty arrays are returned.
+    returns the aligned reference and output data and a list of messages
+    """
+    if len(ref_data) == 0 or len(syn_data) == 0:
+        return ref_data[0:0], syn_data[0:0], []
+
+    tol = coordinate_tolerance(ref_data[:, 0:2], syn_data[:, 0:2])
+
+    # same point order
+    if ref_data.shape == syn_data.shape and np.all(np.abs(ref_data[:, 0:2] - syn_data[:, 0:2]) <= tol):
+        return ref_data, syn_data, []
+
+    index = match_points(ref_data[:, 0:2], syn_data[:, 0:2])
+    matched = (index >= 0)
+    nmatched = np.count_nonzero(matched)
+
+    if nmatched < len(syn_data) or nmatched < len(ref_data):
+        messages = ["Mismatch of points in both files syn/ref = %d / %d, only %d points matched by coordinates"
+                    % (len(syn_data), len(ref_data), nmatched)]
+        return ref_data[0:0], syn_data[0:0], messages
+
+    messages = ["  point order differs in files syn/ref (%d / %d points), all points matched by coordinates"
+                % (len(syn_data), len(ref_data))]
+
+    return ref_data[index], syn_data, messages
+
+
+def compare_kernels(ref,syn):
+    """
+    computes correlations and L2-errors between reference and output kernels
+
+    ref and syn are 2D arrays (points x kernels), all kernel columns are compared at once;
+    returns arrays corr,err with one value per kernel
+    """
+    ref = np.asarray(ref, dtype=np.float64)
+    syn = np.asarray(syn, dtype=np.float64)
+
+    # least square test
+    # normalized by power in reference solution
+    fac_norm = np.sqrt(np.sum(ref*ref, axis=0))
+    # or normalized by power in (ref*syn)
+    #fac_norm = sqrt(norm(ref)*norm(syn))
+    diff_norm = np.sqrt(np.sum((ref-syn)**2, axis=0))
+    zero = (fac_norm == 0.0)
+
+    err = diff_norm.copy()
+    err[~zero] = diff_norm[~zero] / fac_norm[~zero]
+
+    # correlation test
+    # total length
+    ref_c = ref - ref.mean(axis=0)
+    syn_c = syn - syn.mean(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = np.sum(ref_c*syn_c, axis=0) / np.sqrt(np.sum(ref_c**2, axis=0)) / np.sqrt(np.sum(syn_c**2, axis=0))
+    # minimum of correlation matrix, which has ones on its diagonal
+    corr = np.minimum(corr, 1.0)
+
+    # zero reference kernels
+    for i in np.nonzero(zero)[0]:
+        corr[i] = np.cov(ref[:,i]-syn[:,i])
+
+    return corr, err
+
+
+def kernel_accumulators(ref,syn):
+    """
+    computes the streaming accumulators of reference and output kernels (points x kernels)
+
+    returns a 2D array (8 x kernels) with the rows
+      count, mean(ref), mean(syn), sum((ref-mean)^2), sum((syn-mean)^2),
+      sum((ref-mean)*(syn-mean)), sum(ref^2), sum((ref-syn)^2)
+    accumulators of different slices get combined by merge_accumulators()
+    """
+    ref = np.asarray(ref, dtype=np.float64)
+    syn = np.asarray(syn, dtype=np.float64)
+
+    acc = np.zeros((8, ref.shape[1]))
+    acc[0] = ref.shape[0]
+    if ref.shape[0] == 0: return acc
+
+    acc[1] = ref.mean(axis=0)
+    acc[2] = syn.mean(axis=0)
+    ref_c = ref - acc[1]
+    syn_c = syn - acc[2]
+    acc[3] = np.sum(ref_c**2, axis=0)
+    acc[4] = np.sum(syn_c**2, axis=0)
+    acc[5] = np.sum(ref_c*syn_c, axis=0)
+    acc[6] = np.sum(ref*ref, axis=0)
+    acc[7] = np.sum((ref-syn)**2, axis=0)
+    return acc
+
+
+def merge_accumulators(a,b):
+    """
+    combines the accumulators of two sets of points
+
+    uses the pairwise update of means and centered sums (Chan et al.),
+    which avoids the round-off problems of accumulating raw sums of squares
+    """
+    if a is None: return b.copy()
+
+    n_a = a[0]
+    n_b = b[0]
+    n = n_a + n_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(n > 0, n_a * n_b / n, 0.0)
+        f = np.where(n > 0, n_b / n, 0.0)
+    delta_ref = b[1] - a[1]
+    delta_syn = b[2] - a[2]
+
+    acc = np.empty_like(a)
+    acc[0] = n
+    acc[1] = a[1] + delta_ref * f
+    acc[2] = a[2] + delta_syn * f
+    acc[3] = a[3] + b[3] + delta_ref**2 * w
+    acc[4] = a[4] + b[4] + delta_syn**2 * w
+    acc[5] = a[5] + b[5] + delta_ref * delta_syn * w
+    acc[6] = a[6] + b[6]
+    acc[7] = a[7] + b[7]
+    return acc
+
+
+def accumulator_statistics(acc):
+    """
+    returns correlations and L2-errors of the kernels from their accumulators
+
+    gives the same values as compare_kernels() on the concatenated points
+    """
+    fac_norm = np.sqrt(acc[6])
+    diff_norm = np.sqrt(acc[7])
+    zero = (fac_norm == 0.0)
+
+    err = diff_norm.copy()
+    err[~zero] = diff_norm[~zero] / fac_norm[~zero]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = acc[5] / np.sqrt(acc[3]) / np.sqrt(acc[4])
+        # zero reference kernels: variance of difference
+        var_diff = (acc[3] + acc[4] - 2.0 * acc[5]) / (acc[0] - 1.0)
+    corr = np.minimum(corr, 1.0)
+    corr[zero] = var_diff[zero]
+
+    return corr, err
+
+
+def compare_kernel_slice(task):
+    """
+    reads in and compares the kernel files of a single slice
+
+    task is a tuple (name,syn_file,ref_file), returns the slice name, the kernel names,
+    the arrays corr,err, the accumulators (None if the files could not be compared) and a list of messages
+    (called by worker processes when running with several jobs)
+    """
+    name,syn_file,ref_file = task
+
+    # specfem file: proc******_rhop_alpha_beta_kernel.dat
+    kernels = str.split(os.path.basename(syn_file),"_")[1:4]
+
+    # makes sure files are both available
+    if not os.path.isfile(ref_file):
+        return name, kernels, None, None, None, ["  file " + ref_file + " not found"]
+
+    # numpy: reads in file data (each file gets parsed only once)
+    syn_data = read_kernel_file(syn_file)
+    ref_data = read_kernel_file(ref_file)
+
+    # aligns points by coordinates if needed
+    ref_data, syn_data, messages = align_kernel_points(ref_data, syn_data)
+    if len(ref_data) == 0:
+        if len(messages) == 0: messages = ["No matching points in both files syn/ref for slice %s" % name]
+        return name, kernels, None, None, None, messages
+
+    # data format: e.g. #x-coord #y-coord #rhop #alpha #beta
+    nker = min(len(kernels), syn_data.shape[1] - 2)
+    ref = ref_data[:, 2:2+nker]
+    syn = syn_data[:, 2:2+nker]
+
+    corr, err = compare_kernels(ref, syn)
+    acc = kernel_accumulators(ref, syn)
+
+    return name, kernels[0:nker], corr, err, acc, messages
+
+
+def compare_merged_slices(out_dir,ref_dir,ktype):
+    """
+    compares the kernel slices of one file type if output and reference have a different partitioning
+
+    all slices of both directories get read in and the points are matched by their coordinates;
+    returns a list with the results for each output slice like compare_kernel_slice()
+    """
+    syn_files = sorted(glob.glob(out_dir + '/proc*_' + ktype))
+    ref_files = sorted(glob.glob(ref_dir + '/proc*_' + ktype))
+    kernels = str.split(ktype,"_")[0:3]
+
+    if len(ref_files) == 0:
+        return [('all_' + ktype, kernels, None, None, None, ["  no reference files proc******_" + ktype + " found"])]
+
+    ref_data = np.concatenate([read_kernel_file(f) for f in ref_files])
+    syn_slices = [read_kernel_file(f) for f in syn_files]
+    syn_data = np.concatenate(syn_slices)
+
+    # slice of each output point
+    slice_id = np.repeat(np.arange(len(syn_files)), [len(d) for d in syn_slices])
+    del syn_slices
+
+    index = match_points(ref_data[:, 0:2], syn_data[:, 0:2])
+
+    nker = min(len(kernels), syn_data.shape[1] - 2, ref_data.shape[1] - 2)
+    kernels = kernels[0:nker]
+
+    results = []
+    for islice, f in enumerate(syn_files):
+        name = os.path.basename(f)
+        points = (slice_id == islice)
+        nmatched = np.count_nonzero(points & (index >= 0))
+        if nmatched < np.count_nonzero(points):
+            # unmatched output points: slice fails
+            results.append((name, kernels, None, None, None,
+                            ["Mismatch of points in slice %s: only %d of %d points matched by coordinates"
+                             % (name, nmatched, np.count_nonzero(points))]))
+            continue
+        ref = ref_data[index[points], 2:2+nker]
+        syn = syn_data[points, 2:2+nker]
+        corr, err = compare_kernels(ref, syn)
+        results.append((name, kernels, corr, err, kernel_accumulators(ref, syn), []))
+
+    # reference points without output point
+    nref = len(ref_data) - np.count_nonzero(index >= 0)
+    if nref > 0:
+        results.append(('all_' + ktype, kernels, None, None, None,
+                        ["Mismatch of points: %d of %d reference points %s not matched by coordinates"
+                         % (nref, len(ref_data), ktype)]))
+
+    return results
+
+
+def plot_directory_correlations(out_dir,ref_dir,jobs=1):
+    """
+    plots correlation and L2-norm values between all kernel slices in output and reference directory
+
+    the slices proc******_*_kernel.dat are compared one by one (by a pool of worker processes with jobs > 1);
+    global values over all slices are obtained by merging the accumulators of each slice,
+    so no more than one slice per process is held in memory.
+    if the reference has a different set of slices (a different number of MPI processes),
+    all slices get read in and the points are matched by their coordinates
+    """
+    print('comparing kernels')
+    print('  reference directory: %s' % ref_dir)
+    print('  output directory   : %s\n' % out_dir)
+
+    # gets kernel slices
+    files = glob.glob(out_dir + '/proc*_kernel.dat')
+    if len(files) == 0:
+        print "no kernel files proc******_*_kernel.dat found"
+        print "Please check directory: ",out_dir
+        sys.exit(1)
+    files.sort()
+
+    # kernel file types, e.g. rhop_alpha_beta_kernel.dat
+    tasks = []
+    types = []
+    for f in files:
+        fname = os.path.basename(f)
+        names = str.split(fname,"_",1)
+        if names[1] not in types: types.append(names[1])
+        tasks.append((fname, f, ref_dir + '/' + fname))
+
+    # different partitioning
+    ref_files = glob.glob(ref_dir + '/proc*_kernel.dat')
+    merge_slices = (sorted(map(os.path.basename, ref_files)) != [os.path.basename(f) for f in files])
+
+    print "comparing ",len(files),"kernel files"
+    if merge_slices:
+        print "  reference directory holds different slices (",len(ref_files)," files), matching points by coordinates"
+    elif jobs > 1:
+        print "  using ",jobs," parallel jobs"
+    print ""
+
+    # outputs table header
+    print("|%-30s| %13s| %13s|" % ('kernel name', 'corr', 'err'))
+    print("|------------------------------------------------------------|")
+
+    pool = None
+    if merge_slices:
+        results = itertools.chain.from_iterable(compare_merged_slices(out_dir,ref_dir,ktype) for ktype in types)
+    elif jobs > 1:
+        pool = multiprocessing.Pool(processes=jobs)
+        results = pool.imap(compare_kernel_slice, tasks)
+    else:
+        results = (compare_kernel_slice(task) for task in tasks)
+
+    corr_min = 1.0
+    err_max = 0.0
+
+    # global accumulators for each kernel file type
+    accumulators = {}
+    kernel_names = {}
+
+    # counter
+    n = 0
+    nslices = 0
+    for name, kernels, corr, err, acc, messages in results:
+        for msg in messages:
+            print msg
+        if acc is None:
+            # values indicating failure
+            corr_min = 0.0
+            err_max = 1.e9
+            continue
+
+        ktype = str.split(name,"_",1)[1]
+        accumulators[ktype] = merge_accumulators(accumulators.get(ktype), acc)
+        kernel_names[ktype] = kernels
+
+        slice_name = str.split(name,"_",1)[0]
+        for i in range(len(kernels)):
+            # statistics
+            corr_min = min(corr[i], corr_min)
+            err_max = max(err[i], err_max)
+
+            # info string
+            info = ""
+            if corr[i] < TOL_CORR:   info += "  poor correlation"
+            if err[i] > TOL_ERR:     info += "      poor match"
+
+            # print results to screen
+            print("|%-30s| %13.5f| %13.5le| %s" % (slice_name + ' ' + kernels[i], corr[i], err[i], info))
+
+            # counter
+            n += 1
+        nslices += 1
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # global values over all slices
+    print("|------------------------------------------------------------|")
+    for ktype in types:
+        if ktype not in accumulators: continue
+        corr, err = accumulator_statistics(accumulators[ktype])
+        kernels = kernel_names[ktype]
+        for i in range(len(kernels)):
+            info = ""
+            if corr[i] < TOL_CORR:   info += "  poor correlation"
+            if err[i] > TOL_ERR:     info += "      poor match"
+            print("|%-30s| %13.5f| %13.5le| %s" % ('all ' + kernels[i], corr[i], err[i], info))
+
+    if n == 0:
+        corr_min = 0.0
+        err_max = 1.e9
+
+    # print min(coor) max(err) of all slices
+    print("|------------------------------------------------------------|")
+    print("|%30s| %13.5f| %13.5le|" % ('min/max', corr_min, err_max))
+
+    # output summary
+    print("\nsummary:")
+    print("%d kernels compared in %d slices" % (n, nslices))
+    print_summary(corr_min,err_max)
+
+
+def print_summary(corr_min,err_max):
+    """
+    prints the tolerance checks of minimum correlation and maximum L2-error
+    """
+    print("correlations: values 1.0 perfect, < %.1f poor correlation" % TOL_CORR)
+    if corr_min < TOL_CORR:
+        print("              poor correlation seismograms found")
+    else:
+        print("              no poor correlations found")
+    print ""
+
+    print("L2-error    : values 0.0 perfect, > %.2f poor match" % TOL_ERR)
+    if err_max > TOL_ERR:
+        print("              poor matching seismograms found")
+    else:
+        print("              no poor matches found")
+    print ""
+
+
 def plot_correlations(syn_file,ref_file):
     """
     plots correlation and L2-norm values between reference and output file
@@ -31,14 +522,18 @@ def plot_correlations(syn_file,ref_file):
     err_max = 0.0
     shift_max = 0.0
 
+    # numpy: reads in file data (each file gets parsed only once)
+    syn_data = read_kernel_file(syn_file)
+    ref_data = read_kernel_file(ref_file)
+
     # gets x-coordinates
-    syn_x = np.loadtxt(syn_file)[:, 0]
+    syn_x = syn_data[:, 0]
     dx = syn_x[1] - syn_x[0]
     print "  dx size = ",dx
     print ""
 
     # gets y-coordinates
-    #syn_y = np.loadtxt(syn_file)[:, 1]
+    #syn_y = syn_data[:, 1]
     #dy = syn_y[1] - syn_y[0]
     #print "  dy size = ",dy
 
@@ -46,57 +541,33 @@ def plot_correlations(syn_file,ref_file):
     print("|%-30s| %13s| %13s|" % ('kernel name', 'corr', 'err'))
     print("|------------------------------------------------------------|")
 
+    # build reference and synthetics file names
+    # specfem file: proc******_rhop_alpha_beta_kernel.dat
+    fname = os.path.basename(syn_file)
+    names = str.split(fname,"_")
+
+    # kernel names
+    kernels = names[1:4]
+
+    # aligns points by coordinates if the point order differs
+    ref_data, syn_data, messages = align_kernel_points(ref_data, syn_data)
+    for msg in messages:
+        print msg
+    if len(ref_data) == 0:
+        if len(messages) == 0: print("No matching points in both files syn/ref")
+        sys.exit(1)
+
+    # all kernels at once
+    # data format: e.g. #x-coord #y-coord #rhop #alpha #beta
+    corr_all, err_all = compare_kernels(ref_data[:, 2:5], syn_data[:, 2:5])
+
     # counter
     n = 0
-    for i in range(1,4):
-        # build reference and synthetics file names
-        # specfem file: proc******_rhop_alpha_beta_kernel.dat
-        fname = os.path.basename(syn_file)
-        names = str.split(fname,"_")
-
+    for i in range(min(len(kernels), len(corr_all))):
         # trace
-        kernel = names[i]
-
-        # numpy: reads in file data
-        # data format: e.g. #x-coord #y-coord #rhop #alpha #beta
-        iker = i + 1
-        ref = np.loadtxt(ref_file)[:, iker]
-        syn = np.loadtxt(syn_file)[:, iker]
-
-        # length warning
-        if len(ref) != len(syn):
-          print("Mismatch of file length in both files syn/ref = %d / %d" %(len(syn),len(ref)))
-          sys.exit(1)
-
-        # dx step size in reference file
-        ref_x = np.loadtxt(ref_file)[:, 0]
-        dx_ref = ref_x[1] - ref_x[0]
-        # mismatch warning
-        if abs(dx - dx_ref)/dx > 1.e-5:
-          print("Mismatch of dx size in both files syn/ref = %e / %e" %(dx,dx_ref))
-          sys.exit(1)
-
-        # least square test
-        norm = np.linalg.norm
-        sqrt = np.sqrt
-
-        # normalized by power in reference solution
-        fac_norm = norm(ref)
-        # or normalized by power in (ref*syn)
-        #fac_norm = sqrt(norm(ref)*norm(syn))
-        if fac_norm > 0.0:
-            err = norm(ref-syn)/fac_norm
-        else:
-            err = norm(ref-syn)
-        #print('norm syn = %e norm ref = %e' % (norm(syn),fac_norm))
-
-        # correlation test
-        # total length
-        if fac_norm > 0.0:
-            corr_mat = np.corrcoef(ref, syn)
-        else:
-            corr_mat = np.cov(ref-syn)
-        corr = np.min(corr_mat)
+        kernel = kernels[i]
+        corr = corr_all[i]
+        err = err_all[i]
 
         # statistics
         corr_min = min(corr, corr_min)
@@ -120,35 +591,45 @@ def plot_correlations(syn_file,ref_file):
     # output summary
     print("\nsummary:")
     print("%d kernels compared" % n)
-    print("correlations: values 1.0 perfect, < %.1f poor correlation" % TOL_CORR)
-    if corr_min < TOL_CORR:
-        print("              poor correlation seismograms found")
-    else:
-        print("              no poor correlations found")
-    print ""
-
-    print("L2-error    : values 0.0 perfect, > %.2f poor match" % TOL_ERR)
-    if err_max > TOL_ERR:
-        print("              poor matching seismograms found")
-    else:
-        print("              no poor matches found")
-    print ""
+    print_summary(corr_min,err_max)
 
 def usage():
-    print "usage: ./compare_kernel_correlations.py kernel-file1 kernel-file2"
+    print "usage: ./compare_kernel_correlations.py [--jobs N] kernel-file1 kernel-file2"
+    print "   or: ./compare_kernel_correlations.py [--jobs N] directory1/ directory2/"
     print "  with"
     print "     kernel-file1 - ASCII kernel file,"
     print "                    OUTPUT_FILES/proc000000_rhop_alpha_beta_kernel.dat"
     print "     kernel-file1 - ASCII kernel file for reference"
+    print "     directory1   - directory holding the kernel files of all slices proc******_*_kernel.dat,"
+    print "                    e.g. OUTPUT_FILES/"
+    print "     directory2   - directory holding the corresponding reference kernel files"
+    print "     --jobs N     - (optional) number of parallel processes comparing the slices in directory mode"
+    print "                    (default: 1, 0 uses all available cores)"
 
 if __name__ == '__main__':
     # gets arguments
-    if len(sys.argv) != 3:
+    jobs = 1
+    paths = []
+    args = sys.argv[1:]
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == '--jobs':
+            if len(args) == 0:
+                usage()
+                sys.exit(1)
+            jobs = int(args.pop(0))
+            if jobs <= 0: jobs = multiprocessing.cpu_count()
+        else:
+            paths.append(arg)
+
+    if len(paths) != 2:
         usage()
         sys.exit(1)
     else:
-        out_kernel = sys.argv[1]
-        ref_kernel = sys.argv[2]
-
-    plot_correlations(out_kernel,ref_kernel)
+        out_kernel = paths[0]
+        ref_kernel = paths[1]
 
+    if os.path.isdir(out_kernel):
+        plot_directory_correlations(out_kernel,ref_kernel,jobs)
+    else:
+        plot_correlations(out_kernel,ref_kernel)
@@ -5,8 +5,22 @@
 import sys
 import glob
 import os
+import time
+import itertools
+import multiprocessing
+import json
+import csv
 import numpy as np
 
+try:
+    from seismogram_tools import (read_ascii_seismogram, read_seismograms, read_stations,
+                                  find_binary_seismograms, locate_data_file, file_signature,
+                                  load_cached_seismograms, save_cached_seismograms, CACHE_MAX_SIZE)
+except:
+    print("Error importing python file seismogram_tools.py (see in utils/ directory), please make sure it is available/linked in this working directory...")
+    sys.tracebacklimit=0
+    raise Exception("Importing seismogram_tools.py failed")
+
 # tolerance values
 TOL_CORR = 0.8
 TOL_ERR = 0.01
@@ -86,44 +100,275 @@ def get_cross_correlation_timeshift(x,y,dt):
     return time_shift
 
 
-def plot_correlations(out_dir,ref_dir):
+def _fft_cross_correlation(x,y):
     """
-    plots correlation and L2-norm values between reference and output seismograms
+    computes the full cross-correlations of the rows of x with the rows of y
+
+    uses real FFTs of zero-padded power-of-two length, the output has the same layout
+    as np.correlate(x, y, mode='full') along the last axis
     """
-    print('comparing seismograms')
-    print('  reference directory: %s' % ref_dir)
-    print('  output directory   : %s\n' % out_dir)
+    signal_length = x.shape[-1]
+    length = 2 * signal_length - 1
 
-    # seismogram file ending
-    ending = '.sem*' # .semd, .semv, .sema, .semp, ..
+    # zero-padding avoids wrap-around of the circular correlation
+    nfft = 2**int(np.ceil(np.log2(length)))
 
-    # gets seismograms
-    files = glob.glob(out_dir + '/*' + ending)
-    if len(files) == 0:
-        print "no seismogram files with ending ",ending," found"
-        print "Please check directory: ",out_dir
-        sys.exit(1)
+    crosscorrelation = np.fft.irfft(np.fft.rfft(x, nfft) * np.conj(np.fft.rfft(y, nfft)), nfft)
 
-    files.sort()
+    # negative lags are stored at the end of the circular correlation
+    return np.concatenate((crosscorrelation[..., nfft-signal_length+1:],
+                           crosscorrelation[..., :signal_length]), axis=-1)
 
-    corr_min = 1.0
-    err_max = 0.0
-    shift_max = 0.0
 
-    # gets time step size from first file
-    syn_file = files[0]
-    print "  time step: reading from first file ",syn_file
-    syn_time = np.loadtxt(syn_file)[:, 0]
-    dt = syn_time[1] - syn_time[0]
-    print "  time step: size = ",dt
+def _interpolated_peak_lags(crosscorrelation,signal_length):
+    """
+    returns the lags (in samples) of the maxima of the rows of a 2D cross-correlation array
+
+    uses the same quadratic sub-sample interpolation and wrap-around values
+    as get_cross_correlation_timeshift()
+    """
+    length = 2 * signal_length - 1
+    rows = np.arange(crosscorrelation.shape[0])
+
+    # index of maximum (between [0,2 * signal_length - 1]
+    indexmax = np.argmax(crosscorrelation, axis=1)
+    maxval = crosscorrelation[rows, indexmax]
+
+    # gets values left/right from maximum value (wrap-around values at both ends)
+    val_left = crosscorrelation[rows, (indexmax - 1) % length]
+    val_right = crosscorrelation[rows, (indexmax + 1) % length]
+
+    # quadratic interpolation
+    denom = val_left - 2.0*maxval + val_right
+    peak_shift = np.zeros(len(rows))
+    mask = (denom != 0.0)
+    peak_shift[mask] = 0.5 * (val_left[mask] - val_right[mask]) / denom[mask]
+
+    # position (negative -> signal shifted to right, positive -> signal shifted to left)
+    return (indexmax + 1) - signal_length + peak_shift
+
+
+def get_cross_correlation_timeshifts(x,y,dt):
+    """
+    computes the time shifts of the maximum cross-correlations for many pairs of signals at once
+
+    x and y are 2D arrays (traces x samples), e.g. the reference and output seismograms of a station gather;
+    all cross-correlations are computed with one batch of real FFTs of zero-padded power-of-two length.
+    returns the vector of time shifts of the rows of x with respect to the rows of y,
+    using the same sub-sample interpolation as get_cross_correlation_timeshift()
+    """
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+
+    # checks signals
+    if x.shape != y.shape:
+        print "Error: shapes in cross-correlation don't match"
+        return np.ones(x.shape[0]) * 1.e30
+
+    signal_length = x.shape[1]
+
+    # cross-correlation arrays
+    crosscorrelation = _fft_cross_correlation(x, y)
+
+    # zero signals: exact zero cross-correlation, as for the direct computation
+    nonzero = np.logical_and(np.any(x != 0.0, axis=1), np.any(y != 0.0, axis=1))
+    crosscorrelation[~nonzero,:] = 0.0
+
+    # cross-correlation time lags
+    return _interpolated_peak_lags(crosscorrelation, signal_length) * dt
+
+
+def _window_sums(a,window_length):
+    """
+    returns the sums of a over all windows a[i:i+window_length] using cumulative sums
+    """
+    c = np.concatenate(([0.0], np.cumsum(a)))
+    return c[window_length:] - c[:len(c)-window_length]
+
+
+def get_sub_window_correlations(ref,syn,window_length,dt):
+    """
+    computes correlations and cross-correlation time shifts in all moving windows
+
+    the windows start at every sample offset i in range(0,len(ref)-window_length) (as for the former loop),
+    the Pearson coefficients are computed from cumulative sums and the time shifts by batches of FFT cross-correlations
+
+    returns the minimum correlation coefficient (None if no window has a valid correlation)
+    and the time shift with the largest magnitude (None if there are no windows)
+    """
+    length = min(len(ref),len(syn))
+    num_windows = length - window_length
+    if num_windows <= 0 or window_length <= 1:
+        return None, None
+
+    # number of windows per batch, limits the memory of the FFT arrays
+    nfft = 2**int(np.ceil(np.log2(2 * window_length - 1)))
+    batch_size = max(1, 2**22 // nfft)
+
+    corr_w = np.zeros(num_windows)
+    shift_w = np.zeros(num_windows)
+
+    for istart in range(0, num_windows, batch_size):
+        iend = min(istart + batch_size, num_windows)
+        nb = iend - istart
+
+        # signal portion covered by the windows of this batch
+        x = np.ascontiguousarray(ref[istart:iend+window_length-1], dtype=np.float64)
+        y = np.ascontiguousarray(syn[istart:iend+window_length-1], dtype=np.float64)
+
+        # Pearson coefficients from window sums
+        # (cumulative sums are restarted for each batch to limit round-off)
+        sx = _window_sums(x,window_length)
+        sy = _window_sums(y,window_length)
+        cov = _window_sums(x*y,window_length) - sx*sy/window_length
+        var_x = _window_sums(x*x,window_length) - sx*sx/window_length
+        var_y = _window_sums(y*y,window_length) - sy*sy/window_length
+
+        # windows as strided views (no copies)
+        xw = np.lib.stride_tricks.as_strided(x, shape=(nb,window_length), strides=(x.strides[0],x.strides[0]))
+        yw = np.lib.stride_tricks.as_strided(y, shape=(nb,window_length), strides=(y.strides[0],y.strides[0]))
+
+        # zero windows have no valid correlation
+        nonzero = np.logical_and(np.any(xw != 0.0, axis=1), np.any(yw != 0.0, axis=1))
+
+        # the window sums lose their accuracy for windows with a small variance compared to the
+        # total energy in the batch (round-off of the cumulative sums grows with the batch length),
+        # the coefficients of those windows get computed directly
+        tol = 1.e6 * np.finfo(np.float64).eps * len(x) * (1.0 + len(x) / float(window_length))
+        direct = np.logical_and(nonzero, np.logical_or(var_x <= tol * np.dot(x,x), var_y <= tol * np.dot(y,y)))
+        if np.any(direct):
+            xd = xw[direct] - xw[direct].mean(axis=1)[:,None]
+            yd = yw[direct] - yw[direct].mean(axis=1)[:,None]
+            cov[direct] = np.sum(xd*yd, axis=1)
+            var_x[direct] = np.sum(xd*xd, axis=1)
+            var_y[direct] = np.sum(yd*yd, axis=1)
+
+        valid = np.logical_and(nonzero, np.logical_and(var_x > 0.0, var_y > 0.0))
+
+        corr = np.empty(nb)
+        corr.fill(np.nan)
+        corr[valid] = cov[valid] / np.sqrt(var_x[valid]) / np.sqrt(var_y[valid])
+        corr_w[istart:iend] = np.clip(corr, -1.0, 1.0)
+
+        # cross-correlation time shifts of all windows in this batch
+        shift_w[istart:iend] = get_cross_correlation_timeshifts(xw, yw, dt)
+
+    # minimum correlation (ignoring undefined window correlations)
+    valid = ~np.isnan(corr_w)
+    if np.any(valid):
+        corr_min = np.min(corr_w[valid])
+    else:
+        corr_min = None
+
+    # first window with the largest time shift
+    shift_max = shift_w[np.argmax(np.abs(shift_w))]
+
+    return corr_min, shift_max
+
+
+def read_time_step(filename):
+    """
+    reads in time step size and start time from the first two lines of a seismogram file
+    """
+    with open(filename) as f:
+        lines = list(itertools.islice(f, 2))
+    time = np.loadtxt(lines)[:, 0]
+    return time[1] - time[0], time[0]
+
+
+def compare_seismograms(ref_time,ref0,syn0,dt,dt_start,window_length):
+    """
+    computes correlation, L2-error and time shift between reference and output seismogram
+
+    returns (corr,err,shift) together with a list of warning messages,
+    or None instead of the values if the traces are too short for a comparison
+    """
+    messages = []
+
+    # cuts common length
+    length = min(len(ref0),len(syn0))
+    if length <= 1: return None, messages
+
+    # length warning
+    if len(ref0) != len(syn0):
+      messages.append("** warning: mismatch of file length in both files syn/ref = %d / %d" %(len(syn0),len(ref0)))
+      #messages.append("** warning: using smaller length %d" % length)
+
+    # time step size in reference file
+    dt_ref = ref_time[1] - ref_time[0]
     # start time
-    dt_start = syn_time[0]
+    dt_ref_start = ref_time[0]
+
+    # mismatch warning
+    if abs(dt - dt_ref)/dt > 1.e-5:
+      messages.append("** warning: mismatch of time step size in both files syn/ref = %e / %e" %(dt,dt_ref))
+      #messages.append("** warning: using time step size %e" % dt)
+
+    #debug
+    #print "common length: ",length
+
+    ref = ref0[0:length]
+    syn = syn0[0:length]
+
+    # least square test
+    norm = np.linalg.norm
+    sqrt = np.sqrt
 
-    # warning
-    if dt <= 0.0:
-        print "warning: invalid time step size for file ",files[0]
+    # normalized by power in reference solution
+    fac_norm = norm(ref)
+    # or normalized by power in (ref*syn)
+    #fac_norm = sqrt(norm(ref)*norm(syn))
 
-    # determines window length
+    if fac_norm > 0.0:
+        err = norm(ref-syn)/fac_norm
+    else:
+        err = norm(ref-syn)
+
+    #debug
+    #print('norm syn = %e norm ref = %e' % (norm(syn),fac_norm))
+
+    # correlation test
+    # total length
+    if fac_norm > 0.0:
+        corr_mat = np.corrcoef(ref, syn)
+    else:
+        if norm(ref-syn) > 0.0:
+            corr_mat = np.cov(ref-syn)
+        else:
+            # both zero traces
+            messages.append("** warning: comparing zero traces")
+            corr_mat = 1.0
+    corr = np.min(corr_mat)
+
+    # time shift
+    if fac_norm > 0.0:
+      # shift (in s) by cross correlation (FFT based, see get_cross_correlation_timeshift() for the direct version)
+      shift = get_cross_correlation_timeshifts(ref,syn,dt)[0]
+    else:
+      # no correlation with zero trace
+      shift = 0.0
+
+    # correlation in moving window
+    if USE_SUB_WINDOW_CORR:
+        # full trace if no valid time step size was given
+        if window_length is None: window_length = length - 1
+
+        # all windows at once
+        corr_w, shift_w = get_sub_window_correlations(ref,syn,window_length,dt)
+        if corr_w is not None: corr = min(corr, corr_w)
+        if shift_w is not None and abs(shift) < abs(shift_w): shift = shift_w
+
+    # adding shift in start times
+    shift += (dt_ref_start - dt_start)
+
+    return (corr, err, shift), messages
+
+
+def get_window_length(dt):
+    """
+    determines the moving window length for the minimum period (None for the full trace)
+    """
+    window_length = None
     if USE_SUB_WINDOW_CORR:
         # moving window
         print "  using correlations in moving sub-windows"
@@ -131,142 +376,321 @@ def plot_correlations(out_dir,ref_dir):
         # checks
         if dt <= 0.0:
             # use no moving window
-            window_length = len(syn_time) - 1
+            print "  moving window length: full trace"
         else:
             # window length for minimum period
             window_length = int(TMIN/dt)
+            print "  moving window length: ",window_length
+    return window_length
 
-        print "  moving window length: ",window_length
 
+def compare_seismogram_gathers(ref,syn,dt,window_length):
+    """
+    computes correlations, L2-errors and time shifts between all traces of reference and output gathers
 
-    print ""
-    print "comparing ",len(files),"seismograms"
-    print ""
+    ref and syn are 2D arrays (traces x samples) with the same time sampling, e.g. read from binary files;
+    norms, correlation coefficients and time shifts of all traces are computed at once.
+    returns arrays corr,err,shift and a list of warning messages for each trace
+    """
+    ntraces = min(ref.shape[0],syn.shape[0])
+    length = min(ref.shape[1],syn.shape[1])
+
+    ref = np.asarray(ref[0:ntraces,0:length], dtype=np.float64)
+    syn = np.asarray(syn[0:ntraces,0:length], dtype=np.float64)
+
+    messages = [[] for i in range(ntraces)]
+
+    # least square test
+    # normalized by power in reference solution
+    fac_norm = np.sqrt(np.sum(ref*ref, axis=1))
+    diff_norm = np.sqrt(np.sum((ref-syn)**2, axis=1))
+    zero = (fac_norm == 0.0)
+
+    err = diff_norm.copy()
+    err[~zero] = diff_norm[~zero] / fac_norm[~zero]
+
+    # correlation test
+    # total length
+    ref_c = ref - ref.mean(axis=1)[:,None]
+    syn_c = syn - syn.mean(axis=1)[:,None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = np.sum(ref_c*syn_c, axis=1) / np.sqrt(np.sum(ref_c**2, axis=1)) / np.sqrt(np.sum(syn_c**2, axis=1))
+    corr = np.clip(corr, -1.0, 1.0)
+
+    # zero reference traces
+    for i in np.nonzero(zero)[0]:
+        if diff_norm[i] > 0.0:
+            corr[i] = np.cov(ref[i]-syn[i])
+        else:
+            # both zero traces
+            messages[i].append("** warning: comparing zero traces")
+            corr[i] = 1.0
 
-    # outputs table header
-    print("|%-30s| %13s| %13s| %13s|" % ('file name', 'corr', 'err', 'time shift'))
+    # time shifts (in s) by cross correlation, no correlation with zero traces
+    shift = np.zeros(ntraces)
+    if np.any(~zero):
+        shift[~zero] = get_cross_correlation_timeshifts(ref[~zero], syn[~zero], dt)
 
-    # counter
-    n = 0
+    # correlation in moving window
+    if USE_SUB_WINDOW_CORR:
+        # full trace if no valid time step size was given
+        if window_length is None: window_length = length - 1
+
+        for i in range(ntraces):
+            corr_w, shift_w = get_sub_window_correlations(ref[i],syn[i],window_length,dt)
+            if corr_w is not None: corr[i] = min(corr[i], corr_w)
+            if shift_w is not None and abs(shift[i]) < abs(shift_w): shift[i] = shift_w
+
+    return corr, err, shift, messages
+
+
+def compare_binary_files(out_dir,ref_dir,files):
+    """
+    reads in and compares binary or SU seismogram files, trace by trace
+
+    returns a list with the trace name, the comparison values (or None), a list of messages
+    and the load/compute timings for each trace (the timings of a file are given with its first trace)
+    """
+    # gets time step size from first file
+    syn_file = files[0]
+    print "  time step: reading from first file ",syn_file
+    syn, dt = read_seismograms(syn_file)
+    if dt is None:
+        print "warning: unknown time step size (no Par_file found), time shifts are given in samples"
+        dt = 1.0
+    print "  time step: size = ",dt
 
+    # trace names from STATIONS file
+    stations_file = locate_data_file(out_dir, 'STATIONS')
+    if stations_file is not None:
+        stations, networks, x, z = read_stations(stations_file)
+    else:
+        stations = []
+
+    window_length = get_window_length(dt)
+
+    print ""
+    print "comparing ",len(files),"binary seismogram files"
+    print ""
+
+    results = []
     for f in files:
-        # build reference and synthetics file names
-        # specfem file: **network**.**station**.**comp**.sem.ascii
         fname = os.path.basename(f)
-        names = str.split(fname,".")
-
-        # trace
-        net = names[0]
-        sta = names[1]
-        cha = names[2]
-
-        # filenames
-        # old format
-        #fname_old = sta + '.' + net + '.' + cha + '.sem.ascii'
-        #ref_file = ref_dir + '/' + fname_old
-        #syn_file = out_dir + '/' + fname_old
-        # new format
         ref_file = ref_dir + '/' + fname
         syn_file = out_dir + '/' + fname
 
         # makes sure files are both available
         if not os.path.isfile(ref_file):
-            print "  file " + ref_file + " not found"
+            results.append((fname, None, ["  file " + ref_file + " not found"], (0.0, 0.0), None))
             continue
-        if not os.path.isfile(syn_file):
-            print "  file " + syn_file + " not found"
+
+        t_start = time.time()
+
+        # memory-mapped gathers (traces x samples), loaded into memory
+        syn, dt_syn = read_seismograms(syn_file, dt=dt)
+        ref, dt_ref = read_seismograms(ref_file, dt=dt)
+        syn = np.array(syn, dtype=np.float64)
+        ref = np.array(ref, dtype=np.float64)
+
+        t_load = time.time() - t_start
+
+        # mismatch warnings
+        messages = []
+        if syn.shape[0] != ref.shape[0]:
+            messages.append("** warning: mismatch of number of traces in both files syn/ref = %d / %d" %(syn.shape[0],ref.shape[0]))
+        if syn.shape[1] != ref.shape[1]:
+            messages.append("** warning: mismatch of trace length in both files syn/ref = %d / %d" %(syn.shape[1],ref.shape[1]))
+        if min(syn.shape[1],ref.shape[1]) <= 1:
+            results.append((fname, None, messages, (t_load, 0.0), None))
             continue
 
-        # numpy: reads in file data
-        ref0 = np.loadtxt(ref_file)[:, 1]
-        syn0 = np.loadtxt(syn_file)[:, 1]
+        # all traces at once
+        t_start = time.time()
+        corr, err, shift, trace_messages = compare_seismogram_gathers(ref,syn,dt,window_length)
+        timings = (t_load, time.time() - t_start)
 
-        #debug
-        #print "  seismogram: ", fname, "vs", fname_old,"  lengths: ",len(ref0),len(syn0)
+        name = os.path.splitext(fname)[0]
+        for i in range(len(corr)):
+            if len(stations) == len(corr):
+                trace = networks[i] + '.' + stations[i] + '.' + name
+            else:
+                trace = name + '.%05d' % (i+1)
+            results.append((trace, (corr[i], err[i], shift[i]), messages + trace_messages[i], timings, None))
+            messages = []
+            timings = (0.0, 0.0)
 
-        # cuts common length
-        length = min(len(ref0),len(syn0))
-        if length <= 1: continue
+    return results
 
-        # length warning
-        if len(ref0) != len(syn0):
-          print("** warning: mismatch of file length in both files syn/ref = %d / %d" %(len(syn0),len(ref0)))
-          #print("** warning: using smaller length %d" % length)
 
-        # time step size in reference file
-        ref_time = np.loadtxt(ref_file)[:, 0]
-        dt_ref = ref_time[1] - ref_time[0]
-        # start time
-        dt_ref_start = ref_time[0]
+def compare_seismogram_files(task):
+    """
+    reads in and compares a pair of reference and output seismogram files
+
+    task is a tuple (fname,ref_file,syn_file,dt,dt_start,window_length,ref_cached,use_cache),
+    with ref_cached the (time,amplitude) arrays of the reference from the cache or None;
+    returns the file name, the comparison values (or None), a list of messages,
+    the load/compute timings (in s) and the parsed reference as cache entry
+    (signature,time,amplitude) if it had to be read in with use_cache set, otherwise None
+    (called by worker processes when running with several jobs)
+    """
+    fname,ref_file,syn_file,dt,dt_start,window_length,ref_cached,use_cache = task
 
-        # mismatch warning
-        if abs(dt - dt_ref)/dt > 1.e-5:
-          print("** warning: mismatch of time step size in both files syn/ref = %e / %e" %(dt,dt_ref))
-          #print("** warning: using time step size %e from file %s" %(dt,syn_file))
+    # makes sure files are both available
+    if ref_cached is None and not os.path.isfile(ref_file):
+        return fname, None, ["  file " + ref_file + " not found"], (0.0, 0.0), None
+    if not os.path.isfile(syn_file):
+        return fname, None, ["  file " + syn_file + " not found"], (0.0, 0.0), None
 
-        #debug
-        #print "common length: ",length
+    t_start = time.time()
 
-        ref = ref0[0:length]
-        syn = syn0[0:length]
+    # numpy: reads in file data (each file gets parsed only once)
+    ref_entry = None
+    if ref_cached is not None:
+        ref_time, ref0 = ref_cached
+    else:
+        signature = file_signature(ref_file)
+        ref_time, ref0 = read_ascii_seismogram(ref_file)
+        if use_cache: ref_entry = (signature, ref_time, ref0)
+    syn_time, syn0 = read_ascii_seismogram(syn_file)
 
-        # least square test
-        norm = np.linalg.norm
-        sqrt = np.sqrt
+    t_load = time.time() - t_start
 
-        # normalized by power in reference solution
-        fac_norm = norm(ref)
-        # or normalized by power in (ref*syn)
-        #fac_norm = sqrt(norm(ref)*norm(syn))
+    #debug
+    #print "  seismogram: ", fname, "  lengths: ",len(ref0),len(syn0)
 
-        if fac_norm > 0.0:
-            err = norm(ref-syn)/fac_norm
-        else:
-            err = norm(ref-syn)
+    t_start = time.time()
+    values, messages = compare_seismograms(ref_time,ref0,syn0,dt,dt_start,window_length)
+    t_compute = time.time() - t_start
 
-        #debug
-        #print('norm syn = %e norm ref = %e' % (norm(syn),fac_norm))
+    return fname, values, messages, (t_load, t_compute), ref_entry
 
-        # correlation test
-        # total length
-        if fac_norm > 0.0:
-            corr_mat = np.corrcoef(ref, syn)
-        else:
-            if norm(ref-syn) > 0.0:
-                corr_mat = np.cov(ref-syn)
+
+def plot_correlations(out_dir,ref_dir,jobs=1,cache_dir=None,cache_size=CACHE_MAX_SIZE):
+    """
+    plots correlation and L2-norm values between reference and output seismograms
+
+    with jobs > 1, the seismogram files get read in and compared by a pool of worker processes,
+    the table rows are still printed in sorted file order;
+    with a cache directory, parsed ASCII reference seismograms are kept on disk for the next runs;
+    returns the report with the values of all traces, the summary and the timings
+    """
+    t_start = time.time()
+
+    print('comparing seismograms')
+    print('  reference directory: %s' % ref_dir)
+    print('  output directory   : %s\n' % out_dir)
+
+    # seismogram file ending
+    ending = '.sem*' # .semd, .semv, .sema, .semp, ..
+
+    # gets seismograms
+    files = glob.glob(out_dir + '/*' + ending)
+    if len(files) == 0:
+        # binary seismograms (.bin or SU format)
+        binary_files = find_binary_seismograms(out_dir)
+        if len(binary_files) == 0:
+            print "no seismogram files with ending ",ending," or binary seismogram files found"
+            print "Please check directory: ",out_dir
+            sys.exit(1)
+
+    corr_min = 1.0
+    err_max = 0.0
+    shift_max = 0.0
+
+    pool = None
+    cache = None
+    if len(files) == 0:
+        # compares whole gathers of binary files
+        results = compare_binary_files(out_dir,ref_dir,binary_files)
+
+        # outputs table header
+        print("|%-30s| %13s| %13s| %13s|" % ('file name', 'corr', 'err', 'time shift'))
+    else:
+        files.sort()
+
+        # gets time step size from first file
+        syn_file = files[0]
+        print "  time step: reading from first file ",syn_file
+        dt, dt_start = read_time_step(syn_file)
+        print "  time step: size = ",dt
+
+        # warning
+        if dt <= 0.0:
+            print "warning: invalid time step size for file ",files[0]
+
+        # determines window length
+        window_length = get_window_length(dt)
+
+        print ""
+        print "comparing ",len(files),"seismograms"
+        if jobs > 1:
+            print "  using ",jobs," parallel jobs"
+        print ""
+
+        # cached reference seismograms
+        if cache_dir is not None:
+            cache = load_cached_seismograms(cache_dir, ref_dir)
+            print "  reference cache: ",len(cache)," of ",len(files)," seismograms found in ",cache_dir
+            print ""
+
+        # outputs table header
+        print("|%-30s| %13s| %13s| %13s|" % ('file name', 'corr', 'err', 'time shift'))
+
+        # build reference and synthetics file names
+        # specfem file: **network**.**station**.**comp**.sem.ascii
+        tasks = []
+        for f in files:
+            fname = os.path.basename(f)
+
+            # filenames
+            # old format
+            #names = str.split(fname,".")
+            #fname_old = names[1] + '.' + names[0] + '.' + names[2] + '.sem.ascii'
+            #ref_file = ref_dir + '/' + fname_old
+            #syn_file = out_dir + '/' + fname_old
+            # new format
+            ref_file = ref_dir + '/' + fname
+            syn_file = out_dir + '/' + fname
+
+            if cache is not None:
+                tasks.append((fname,ref_file,syn_file,dt,dt_start,window_length,cache.get(fname),True))
             else:
-                # both zero traces
-                print("** warning: comparing zero traces")
-                corr_mat = 1.0
-        corr = np.min(corr_mat)
-
-        # time shift
-        if fac_norm > 0.0:
-          # shift (in s) by cross correlation
-          shift = get_cross_correlation_timeshift(ref,syn,dt)
+                tasks.append((fname,ref_file,syn_file,dt,dt_start,window_length,None,False))
+
+        # compares seismograms
+        if jobs > 1:
+            # worker processes, results are returned in order of the tasks
+            pool = multiprocessing.Pool(processes=jobs)
+            chunksize = max(1, len(tasks) // (4 * jobs))
+            results = pool.imap(compare_seismogram_files, tasks, chunksize)
         else:
-          # no correlation with zero trace
-          shift = 0.0
+            results = (compare_seismogram_files(task) for task in tasks)
+
+    # counter
+    n = 0
+
+    # report entries
+    traces = []
+    t_load = 0.0
+    t_compute = 0.0
+
+    # newly parsed reference seismograms
+    cache_entries = {}
+
+    for fname, values, messages, timings, ref_entry in results:
+        for msg in messages:
+            print msg
 
-        # correlation in moving window
-        if USE_SUB_WINDOW_CORR:
-            # moves window through seismogram
-            for i in range(0,length-window_length):
-                # windowed signals
-                x = ref[i:i+window_length]
-                y = syn[i:i+window_length]
+        if ref_entry is not None:
+            cache_entries[fname] = ref_entry
 
-                # correlations
-                corr_win = np.corrcoef(x, y)
-                corr_w = np.min(corr_win)
-                corr = min(corr, corr_w)
+        t_load += timings[0]
+        t_compute += timings[1]
 
-                # cross-correlation array
-                shift_w = get_cross_correlation_timeshift(x,y,dt)
-                if abs(shift) < abs(shift_w): shift = shift_w
+        # skips missing files and too short traces
+        if values is None: continue
 
-        # adding shift in start times
-        shift += (dt_ref_start - dt_start)
+        corr, err, shift = values
 
         # statistics
         corr_min = min(corr, corr_min)
@@ -282,9 +706,30 @@ def plot_correlations(out_dir,ref_dir):
         # print results to screen
         print("|%-30s| %13.5f| %13.5le| %13.5le| %s" % (fname, corr, err, shift, info))
 
+        traces.append({'name': fname,
+                       'corr': float(corr),
+                       'err': float(err),
+                       'shift': float(shift),
+                       'poor_correlation': bool(corr < TOL_CORR),
+                       'poor_match': bool(err > TOL_ERR),
+                       'significant_shift': bool(abs(shift) > TOL_SHIFT)})
+
         # counter
         n += 1
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # updates cache file of reference directory
+    if len(cache_entries) > 0:
+        for fname in cache:
+            if fname not in cache_entries:
+                cache_entries[fname] = (file_signature(ref_dir + '/' + fname),) + tuple(cache[fname])
+        try:
+            save_cached_seismograms(cache_dir, ref_dir, cache_entries, cache_size)
+        except (IOError, OSError) as e:
+            print "warning: could not write reference cache: ",e
 
     # check if any comparison done
     if n == 0:
@@ -324,23 +769,143 @@ def plot_correlations(out_dir,ref_dir):
         print("              no significant time shifts found")
     print ""
 
+    # report
+    # (nan values, e.g. correlations with zero traces, count as violations)
+    passed = (n > 0 and not corr_min < TOL_CORR and not err_max > TOL_ERR and not abs(shift_max) > TOL_SHIFT
+              and not any(np.isnan(t['corr']) or np.isnan(t['err']) for t in traces))
+
+    report = {'reference_directory': ref_dir,
+              'output_directory': out_dir,
+              'tolerances': {'corr': TOL_CORR, 'err': TOL_ERR, 'shift': TOL_SHIFT},
+              'summary': {'compared': n,
+                          'corr_min': float(corr_min),
+                          'err_max': float(err_max),
+                          'shift_max': float(shift_max),
+                          'passed': bool(passed)},
+              'timings': {'load': t_load,
+                          'compute': t_compute,
+                          'total': time.time() - t_start,
+                          'jobs': jobs},
+              'traces': traces}
+    return report
+
+
+def _json_value(value):
+    """
+    replaces non-finite numbers by None, which are no valid JSON values
+    """
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    if isinstance(value, dict):
+        return dict((k, _json_value(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_json_value(v) for v in value]
+    return value
+
+
+def write_json_report(report,f):
+    """
+    writes the comparison report in JSON format
+    """
+    json.dump(_json_value(report), f, indent=2, separators=(',', ': '), sort_keys=True)
+    f.write('\n')
+
+
+def write_csv_report(report,f):
+    """
+    writes the comparison report in CSV format, one row per trace
+
+    summary and timings are appended as comment lines starting with '#'
+    """
+    columns = ['name', 'corr', 'err', 'shift', 'poor_correlation', 'poor_match', 'significant_shift']
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerow(columns)
+    for trace in report['traces']:
+        writer.writerow([repr(trace[c]) if isinstance(trace[c], float) else trace[c] for c in columns])
+
+    for section in ['summary', 'timings']:
+        for key in sorted(report[section]):
+            value = report[section][key]
+            if isinstance(value, float): value = repr(value)
+            f.write('# %s.%s = %s\n' % (section, key, value))
+
 
 def usage():
-    print "usage: ./compare_seismogram_correlations.py directory1/ directory2/"
+    print "usage: ./compare_seismogram_correlations.py [--jobs N] [--json | --csv] [--cache DIR] directory1/ directory2/"
     print "  with"
     print "     directory1 - directory holding seismogram files (***.sem.ascii),"
     print "                    e.g. OUTPUT_FILES/"
     print "     directory2 - directory holding corresponding reference seismogram files,"
     print "                    e.g. OUTPUT_FILES_reference_OK/"
+    print "     --jobs N   - (optional) number of parallel processes reading and comparing the files"
+    print "                    (default: 1, 0 uses all available cores)"
+    print "     --json     - (optional) writes a report with the values of all traces, the summary and timings"
+    print "                    in JSON format to stdout"
+    print "     --csv      - (optional) same report in CSV format (summary and timings as '#' comment lines)"
+    print ""
+    print "     --cache DIR - (optional) keeps the parsed ASCII reference seismograms in cache directory DIR,"
+    print "                    repeated comparisons against the same reference directory skip the parsing"
+    print "                    (cache entries are invalidated by changes of file size or modification time)"
+    print "     --cache-size MB - (optional) maximum size of the cache directory, least recently used"
+    print "                    directories get evicted (default: %d MB)" % (CACHE_MAX_SIZE // 1024**2)
+    print ""
+    print "  in report mode, the table output goes to stderr and the script exits with status 1"
+    print "  if any of the tolerances TOL_CORR, TOL_ERR or TOL_SHIFT is violated"
+    print ""
+    print "  if directory1 holds no ASCII seismograms, the binary seismogram files U*_file_single.bin,"
+    print "  U*_file_double.bin or U*_file_single.su get compared trace by trace"
+    print "  (number of receivers and time step size read from the STATIONS and Par_file files in directory1 or directory1/../DATA/)"
 
 if __name__ == '__main__':
     # gets arguments
-    if len(sys.argv) != 3:
+    jobs = 1
+    report_format = None
+    cache_dir = None
+    cache_size = CACHE_MAX_SIZE
+    dirs = []
+    args = sys.argv[1:]
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == '--jobs':
+            if len(args) == 0:
+                usage()
+                sys.exit(1)
+            jobs = int(args.pop(0))
+            if jobs <= 0: jobs = multiprocessing.cpu_count()
+        elif arg == '--cache' or arg == '--cache-size':
+            if len(args) == 0:
+                usage()
+                sys.exit(1)
+            if arg == '--cache':
+                cache_dir = args.pop(0)
+            else:
+                cache_size = int(float(args.pop(0)) * 1024**2)
+        elif arg == '--json' or arg == '--csv':
+            report_format = arg[2:]
+        else:
+            dirs.append(arg)
+
+    if len(dirs) != 2:
         usage()
         sys.exit(1)
     else:
-        out_dir = sys.argv[1]
-        ref_dir = sys.argv[2]
+        out_dir = dirs[0]
+        ref_dir = dirs[1]
 
-    plot_correlations(out_dir,ref_dir)
+    if report_format is None:
+        plot_correlations(out_dir,ref_dir,jobs,cache_dir,cache_size)
+    else:
+        # table output to stderr, report to stdout
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        report = plot_correlations(out_dir,ref_dir,jobs,cache_dir,cache_size)
+        sys.stdout = stdout
+
+        if report_format == 'json':
+            write_json_report(report,sys.stdout)
+        else:
+            write_csv_report(report,sys.stdout)
 
+        # exit code for tolerance violations
+        if not report['summary']['passed']:
+            sys.exit(1)
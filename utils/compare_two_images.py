@@ -32,6 +32,11 @@
 from __future__ import (absolute_import, division, print_function)
 
 import sys
+import os
+import glob
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 try:
     import numpy as np
@@ -90,6 +95,21 @@ TOL_SIM = 0.99
 # verbosity
 VERBOSE = False
 
+# directory mode: number of frames with lowest similarity listed in summary
+NUM_WORST_FRAMES = 10
+
+# directory mode: image file endings
+IMAGE_ENDINGS = ['.jpg', '.jpeg', '.png', '.gif', '.ppm', '.pnm']
+
+# fast mode (tiled structural similarity):
+# tile size (in pixels)
+FAST_SSIM_TILE = 256
+# number of threads computing the tiles (0 shares the available cores among the parallel jobs)
+FAST_SSIM_THREADS = 0
+
+# window size of structural similarity (default of skimage)
+SSIM_WIN_SIZE = 7
+
 #####################################################################
 
 def mse(imageA, imageB):
@@ -104,9 +124,85 @@ def mse(imageA, imageB):
     return err
 
 
-def compare_images(imageA, imageB, title, show_plot=True):
+def ssim_map(img1, img2):
+    """
+    returns the local structural similarity values of two greyscale images
+    """
+    s, S = ssim(img1, img2, full=True)
+    return S
+
+
+def fast_ssim(img1, img2, threads=1):
+    """
+    computes the structural similarity of two greyscale images tile by tile
+
+    the images are split into tiles; tiles which are identical at full resolution (including the halo
+    of the similarity window) have a similarity of exactly 1, all other tiles get compared at full resolution
+    (by a pool of threads). the result is the same as the full-resolution comparison,
+    identical or almost identical images are checked at the cost of an array comparison.
+    """
+    ny, nx = img1.shape
+    tile = FAST_SSIM_TILE
+
+    # border excluded from mean similarity (like in skimage)
+    pad = (SSIM_WIN_SIZE - 1) // 2
+
+    # too small for tiles
+    if min(ny, nx) <= tile:
+        return ssim(img1, img2)
+
+    try:
+        ssim_map(img1[0:SSIM_WIN_SIZE, 0:SSIM_WIN_SIZE], img2[0:SSIM_WIN_SIZE, 0:SSIM_WIN_SIZE])
+    except TypeError:
+        # older ssim versions without full similarity map
+        return ssim(img1, img2)
+
+    # tiles within the image region which contributes to the mean similarity
+    total = 0.0
+    refine = []
+    for y0 in range(pad, ny - pad, tile):
+        for x0 in range(pad, nx - pad, tile):
+            y1 = min(y0 + tile, ny - pad)
+            x1 = min(x0 + tile, nx - pad)
+            if np.array_equal(img1[y0-pad:y1+pad, x0-pad:x1+pad], img2[y0-pad:y1+pad, x0-pad:x1+pad]):
+                # identical tile
+                total += (y1 - y0) * (x1 - x0)
+            else:
+                refine.append((y0, y1, x0, x1))
+
+    def tile_sum(t):
+        # full resolution similarity of a tile, computed with a halo of pad pixels
+        y0, y1, x0, x1 = t
+        S = ssim_map(img1[y0-pad:y1+pad, x0-pad:x1+pad], img2[y0-pad:y1+pad, x0-pad:x1+pad])
+        return S[pad:pad+y1-y0, pad:pad+x1-x0].sum()
+
+    if VERBOSE: print("fast ssim: %d tiles compared at full resolution" % len(refine))
+
+    if len(refine) > 0:
+        if threads > 1 and len(refine) > 1:
+            pool = ThreadPool(processes=min(threads, len(refine)))
+            total += sum(pool.map(tile_sum, refine))
+            pool.close()
+            pool.join()
+        else:
+            total += sum(tile_sum(t) for t in refine)
+
+    return total / float((ny - 2 * pad) * (nx - 2 * pad))
+
+
+def fast_ssim_threads(jobs=1):
+    """
+    returns the number of threads of fast_ssim() in each of the jobs parallel processes
+    """
+    if FAST_SSIM_THREADS > 0: return FAST_SSIM_THREADS
+    return max(1, multiprocessing.cpu_count() // max(1, jobs))
+
+
+def compare_images(imageA, imageB, title, show_plot=True, fast=False, threads=1):
     """
     computes the mean squared error and structural similarity
+
+    with fast set, the structural similarity is computed by the tiled fast_ssim() using threads threads
     """
 
     # index values for mean squared error
@@ -124,7 +220,10 @@ def compare_images(imageA, imageB, title, show_plot=True):
 
     # index values for structural similarity
     if VERBOSE: print("comparing structural similarity...")
-    s = ssim(img1_grey, img2_grey)
+    if fast:
+        s = fast_ssim(img1_grey, img2_grey, threads)
+    else:
+        s = ssim(img1_grey, img2_grey)
 
     if show_plot:
         if VERBOSE: print("plotting images...")
@@ -165,7 +264,7 @@ def compare_images(imageA, imageB, title, show_plot=True):
     return m, s
 
 
-def plot_image_comparison(image1,image2,show):
+def plot_image_comparison(image1,image2,show,fast=False):
     """
     plots comparison between two images
     """
@@ -185,7 +284,7 @@ def plot_image_comparison(image1,image2,show):
     imageB = imread(image2)
 
     # compare the images
-    m, s = compare_images(imageA, imageB, "Image 1 vs. Image 2", show_plot=show)
+    m, s = compare_images(imageA, imageB, "Image 1 vs. Image 2", show_plot=show, fast=fast, threads=fast_ssim_threads())
 
     # user output
     print("")
@@ -208,29 +307,192 @@ def plot_image_comparison(image1,image2,show):
         sys.exit(0)
 
 
+def compare_image_files(task):
+    """
+    loads and compares a pair of image files, without plotting
+
+    task is a tuple (name,image1,image2,fast,threads), returns a dictionary with the frame name,
+    mean squared error and structural similarity (None and an error message if the images can't be compared)
+    (called by worker processes when running with several jobs)
+    """
+    name,image1,image2,fast,threads = task
+
+    result = {'name': name, 'mse': None, 'ssim': None}
+
+    try:
+        imageA = imread(image1)
+        imageB = imread(image2)
+    except Exception as e:
+        result['error'] = "loading images failed: %s" % e
+        return result
+
+    if imageA.shape != imageB.shape:
+        result['error'] = "image sizes differ: %s / %s" % (str(imageA.shape), str(imageB.shape))
+        return result
+
+    m, s = compare_images(imageA, imageB, name, show_plot=False, fast=fast, threads=threads)
+
+    result['mse'] = float(m)
+    result['ssim'] = float(s)
+    return result
+
+
+def compare_image_directories(dir1,dir2,jobs=1,json_file='image_comparison.json',fast=False):
+    """
+    compares all images in directory dir1 with the images of the same name in directory dir2
+
+    frames get decoded and compared by a pool of worker processes (with jobs > 1), without plotting;
+    writes a JSON summary with the values of all frames and the frames of lowest similarity
+    """
+    print("comparing image directories:")
+    print("  directory 1 = %s" % dir1)
+    print("  directory 2 = %s" % dir2)
+    print("")
+
+    # pairs frames by name
+    files = []
+    for ending in IMAGE_ENDINGS:
+        files += glob.glob(os.path.join(dir1, '*' + ending))
+    names = sorted(os.path.basename(f) for f in files)
+
+    missing = [name for name in names if not os.path.isfile(os.path.join(dir2, name))]
+    # threads of each process for the tiles of fast mode
+    threads = fast_ssim_threads(jobs)
+    tasks = [(name, os.path.join(dir1, name), os.path.join(dir2, name), fast, threads)
+             for name in names if name not in missing]
+
+    if len(tasks) == 0:
+        print("no pairs of images found for comparison")
+        print("Please check directories: %s %s" % (dir1, dir2))
+        sys.exit(1)
+
+    print("  comparing %d frames" % len(tasks))
+    if jobs > 1:
+        print("  using %d parallel jobs" % jobs)
+    for name in missing:
+        print("  frame %s not found in directory 2" % name)
+    print("")
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(processes=jobs)
+        results = pool.map(compare_image_files, tasks, max(1, len(tasks) // (4 * jobs)))
+        pool.close()
+        pool.join()
+    else:
+        results = [compare_image_files(task) for task in tasks]
+
+    # user output
+    print("|%-30s| %13s| %13s|" % ('frame', 'mse', 'ssim'))
+    failed = []
+    for result in results:
+        if result['ssim'] is None:
+            print("|%-30s| %s" % (result['name'], result['error']))
+            failed.append(result['name'])
+            continue
+        info = ""
+        if result['ssim'] < TOL_SIM:
+            info = "  poor image similarity"
+            failed.append(result['name'])
+        print("|%-30s| %13.5f| %13.5f| %s" % (result['name'], result['mse'], result['ssim'], info))
+
+    # compared frames sorted by similarity
+    compared = [r for r in results if r['ssim'] is not None]
+    worst = sorted(compared, key=lambda r: (r['ssim'], -r['mse']))[0:NUM_WORST_FRAMES]
+
+    summary = {'directory1': dir1,
+               'directory2': dir2,
+               'tolerance_ssim': TOL_SIM,
+               'frames_compared': len(compared),
+               'frames_failed': failed,
+               'frames_missing': missing,
+               'mse_max': max([r['mse'] for r in compared]) if len(compared) > 0 else None,
+               'ssim_min': min([r['ssim'] for r in compared]) if len(compared) > 0 else None,
+               'worst_frames': [r['name'] for r in worst],
+               'frames': results}
+
+    with open(json_file, 'w') as f:
+        json.dump(summary, f, indent=2, separators=(',', ': '), sort_keys=True)
+        f.write('\n')
+
+    print("")
+    print("structural similarity: values 1.0 perfect, < %.2f poor similarity" % TOL_SIM)
+    print("")
+    if len(worst) > 0:
+        print("frames with lowest similarity:")
+        for r in worst:
+            print("  %-30s ssim = %f  mse = %f" % (r['name'], r['ssim'], r['mse']))
+        print("")
+    print("summary written to: %s" % json_file)
+    print("")
+    print("result:")
+    if len(failed) > 0 or len(missing) > 0:
+        # Failure
+        print("  poor image similarity found (%d of %d frames)" % (len(failed), len(tasks)))
+        print("")
+        sys.exit(1)
+    else:
+        # Success
+        print("  good image similarity found")
+        print("")
+        sys.exit(0)
+
+
 def usage():
-    print("usage: ./compare_two_images.py image1 image2 (show)")
+    print("usage: ./compare_two_images.py [--fast] image1 image2 (show)")
+    print("   or: ./compare_two_images.py [--fast] [--jobs N] [--json file] directory1 directory2")
     print("  with")
     print("     image1,image2   - path to images (jpg,png) for comparison")
     print("     (optional) show - set to 1 to show image plots, otherwise only outputs comparison values")
+    print("     directory1,directory2 - directories holding the images (e.g. movie frames image*.jpg),")
+    print("                       all images in directory1 are compared with the images of the same name in directory2")
+    print("     --jobs N        - (optional) number of parallel processes comparing the frames")
+    print("                       (default: 1, 0 uses all available cores)")
+    print("     --json file     - (optional) file name of JSON summary (default: image_comparison.json)")
+    print("     --fast          - (optional) tiled structural similarity, skips identical tiles")
+    print("                       and compares only tiles with differences at full resolution")
 
 if __name__ == '__main__':
     # initialize
     image1 = ''
     image2 = ''
     show = False
+    jobs = 1
+    json_file = 'image_comparison.json'
+    fast = False
 
     # gets arguments
-    if len(sys.argv) < 2 or len(sys.argv) > 4:
+    paths = []
+    args = sys.argv[1:]
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg in ['--jobs', '--json']:
+            if len(args) == 0:
+                usage()
+                sys.exit(1)
+            if arg == '--jobs':
+                jobs = int(args.pop(0))
+                if jobs <= 0: jobs = multiprocessing.cpu_count()
+            else:
+                json_file = args.pop(0)
+        elif arg == '--fast':
+            fast = True
+        else:
+            paths.append(arg)
+
+    if len(paths) < 2 or len(paths) > 3:
         usage()
         sys.exit(1)
     else:
-        image1 = sys.argv[1]
-        image2 = sys.argv[2]
-        if len(sys.argv) == 4:
-            if int(sys.argv[3]) == 1: show = True
-
-    # compares images
-    plot_image_comparison(image1,image2,show)
+        image1 = paths[0]
+        image2 = paths[1]
+        if len(paths) == 3:
+            if int(paths[2]) == 1: show = True
+
+    if os.path.isdir(image1) and os.path.isdir(image2):
+        # compares all frames in directories
+        compare_image_directories(image1,image2,jobs,json_file,fast)
+    else:
+        # compares images
+        plot_image_comparison(image1,image2,show,fast)
 
 
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+#
+# shared routines to read SPECFEM2D seismograms into NumPy arrays
+#
+# supported formats (see src/specfem2D/write_seismograms.F90 and write_output_SU.f90):
+#   - ASCII files   **network**.**station**.**comp**.sem*
+#                   two columns: time, amplitude
+#   - binary files  U*_file_single.bin, U*_file_double.bin
+#                   raw single/double precision values without any header,
+#                   all samples of the first receiver, then all samples of the second receiver, ...
+#   - Seismic Unix  U*_file_single.su
+#                   240-byte header followed by the single precision samples for each receiver
+#
+# binary and SU files get memory-mapped and returned with a layout (traces x samples)
+#
+# parsed ASCII seismograms of a (reference) directory can be stored in an on-disk cache,
+# one .npz file per directory, valid as long as size and modification time of the files don't change
+#
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import re
+import glob
+import hashlib
+import warnings
+import numpy as np
+
+# Seismic Unix trace header size (in bytes)
+SU_HEADER_SIZE = 240
+
+# maximum total size of the seismogram cache directory (in bytes)
+CACHE_MAX_SIZE = 2 * 1024**3
+
+# size of the blocks of an ASCII file parsed at once by the block-wise readers (in bytes)
+ASCII_BLOCK_SIZE = 2**22
+
+# data lines and blank lines of ASCII files (lines holding a comment only are no data lines, like in np.loadtxt)
+DATA_LINE = re.compile(r'^[ \t\r\f\v]*[^\s#]', re.M)
+BLANK_LINE = re.compile(r'\n[ \t\r\f\v]*\n')
+
+
+def count_data_lines(text):
+    """
+    returns the number of data lines of an ASCII text, blank lines and comment lines are not counted
+
+    the lines are counted by their line endings, the line by line count is only needed
+    for texts holding blank lines (except at the end) or comments
+    """
+    # trailing blank lines
+    end = len(text)
+    while end > 0 and text[end-1].isspace(): end -= 1
+    if end == 0: return 0
+
+    first = text[0:text.find('\n') + 1]
+    if '#' in text or BLANK_LINE.search(text, 0, end) or BLANK_LINE.match('\n' + first):
+        return len(DATA_LINE.findall(text))
+    return text.count('\n', 0, end) + 1
+
+
+def count_columns(text):
+    """
+    returns the number of columns of the first data line of an ASCII text
+    """
+    line = DATA_LINE.search(text)
+    if line is None: return 0
+    end = text.find('\n', line.start())
+    if end < 0: end = len(text)
+    return len(text[line.start():end].split('#')[0].split())
+
+
+def count_ascii_rows(filename, block_size=ASCII_BLOCK_SIZE):
+    """
+    returns the number of data lines (rows) and the number of columns of an ASCII file,
+    read block by block (without parsing the numbers)
+    """
+    nrows = 0
+    ncols = None
+    with open(filename) as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            # completes the last line of the block
+            block += f.readline()
+            if ncols is None and DATA_LINE.search(block): ncols = count_columns(block)
+            nrows += count_data_lines(block)
+    return nrows, ncols or 0
+
+
+def parse_ascii_block(text, ncols):
+    """
+    parses a whitespace-separated ASCII text of numbers with ncols columns as 2D array (rows x columns)
+
+    np.fromstring parses the text in one go, which is much faster than np.loadtxt;
+    falls back to np.loadtxt for texts with comments or irregular rows
+    """
+    nrows = count_data_lines(text)
+    if nrows == 0:
+        return np.empty((0, ncols))
+    if ncols > 0:
+        with warnings.catch_warnings():
+            # parse errors stop np.fromstring early, checked by the total size below
+            warnings.simplefilter("ignore")
+            values = np.fromstring(text, dtype=np.float64, sep=' ')
+        if values.size == nrows * ncols:
+            return values.reshape(nrows, ncols)
+
+    # slow but tolerant version
+    return np.loadtxt(text.splitlines(), ndmin=2)
+
+
+def read_ascii_columns(filename):
+    """
+    reads in a whitespace-separated ASCII file of numbers as 2D array (rows x columns)
+
+    the file gets parsed in one go by parse_ascii_block()
+    """
+    with open(filename) as f:
+        text = f.read()
+    return parse_ascii_block(text, count_columns(text))
+
+
+def read_ascii_column_blocks(filename, usecols=None, dtype=np.float64, block_size=ASCII_BLOCK_SIZE):
+    """
+    reads in the columns usecols (default: all) of a whitespace-separated ASCII file, block_size bytes at a time
+
+    returns the data as 2D array (columns x rows) of type dtype and the min/max values of each column,
+    computed block by block while reading (no full-size temporary array of the file)
+    """
+    nrows, ncols = count_ascii_rows(filename, block_size)
+    if usecols is None: usecols = range(ncols)
+    usecols = list(usecols)
+
+    data = np.empty((len(usecols), nrows), dtype=dtype)
+    vmin = np.full(len(usecols), np.inf)
+    vmax = np.full(len(usecols), -np.inf)
+
+    n = 0
+    with open(filename) as f:
+        for text in iter(lambda: f.read(block_size), ''):
+            # completes the last line of the block
+            text += f.readline()
+            block = parse_ascii_block(text, ncols)
+            if len(block) == 0: continue
+            block = block[:, usecols]
+            data[:, n:n+len(block)] = block.T
+            vmin = np.minimum(vmin, block.min(axis=0))
+            vmax = np.maximum(vmax, block.max(axis=0))
+            n += len(block)
+
+    return data[:, 0:n], vmin, vmax
+
+
+def read_ascii_seismogram(filename):
+    """
+    reads in an ASCII seismogram file
+
+    returns the time and amplitude columns (the file gets parsed only once)
+    """
+    data = read_ascii_columns(filename)
+    return data[:, 0], data[:, 1]
+
+
+def is_su_file(filename):
+    """
+    checks if the file is a Seismic Unix file (by its ending)
+    """
+    return filename.endswith('.su')
+
+
+def is_binary_file(filename):
+    """
+    checks if the file is a raw binary seismogram file (by its ending)
+    """
+    return filename.endswith('.bin')
+
+
+def find_binary_seismograms(directory):
+    """
+    returns the sorted list of binary and SU seismogram files in a directory
+    """
+    files = glob.glob(os.path.join(directory, 'U*_file_single.bin'))
+    files += glob.glob(os.path.join(directory, 'U*_file_double.bin'))
+    files += glob.glob(os.path.join(directory, 'U*_file_single.su'))
+    files.sort()
+    return files
+
+
+def locate_data_file(directory, name):
+    """
+    looks for a file like STATIONS or Par_file next to the seismograms
+
+    checks the given directory and the DATA/ directory next to it,
+    returns the path or None if the file can't be found
+    """
+    for path in [os.path.join(directory, name),
+                 os.path.join(directory, '..', 'DATA', name)]:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def read_stations(filename):
+    """
+    reads in a STATIONS file
+
+    returns lists of station and network names and arrays of x/z coordinates
+    """
+    stations = []
+    networks = []
+    x = []
+    z = []
+    with open(filename) as f:
+        for line in f:
+            items = line.split()
+            if len(items) < 4 or items[0].startswith('#'): continue
+            stations.append(items[0])
+            networks.append(items[1])
+            x.append(float(items[2]))
+            z.append(float(items[3]))
+    return stations, networks, np.array(x), np.array(z)
+
+
+def read_par_file_value(filename, name):
+    """
+    returns the value string of a parameter in a Par_file (or None if not found)
+    """
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#')[0]
+            if '=' not in line: continue
+            key, value = line.split('=', 1)
+            if key.strip() == name:
+                return value.strip()
+    return None
+
+
+def read_seismogram_sampling(filename):
+    """
+    reads in time step size and number of samples of the seismograms from a Par_file
+
+    takes subsampling of the seismograms into account, returns (dt, nsamples)
+    """
+    dt = float(read_par_file_value(filename, 'DT').replace('d', 'e').replace('D', 'E'))
+    nstep = int(read_par_file_value(filename, 'NSTEP'))
+
+    subsamp = read_par_file_value(filename, 'subsamp_seismos')
+    if subsamp is None:
+        subsamp = 1
+    else:
+        subsamp = int(subsamp)
+
+    return dt * subsamp, nstep // subsamp
+
+
+def read_binary_seismograms(filename, nrec=None, nsamples=None):
+    """
+    reads in a binary seismogram file U*_file_single.bin or U*_file_double.bin
+
+    either the number of receivers or the number of samples per trace must be given;
+    returns a read-only memory-mapped array (nrec x nsamples)
+    """
+    if 'double' in os.path.basename(filename):
+        dtype = np.float64
+    else:
+        dtype = np.float32
+
+    data = np.memmap(filename, dtype=dtype, mode='r')
+
+    if nrec is None and nsamples is None:
+        raise ValueError('number of receivers or samples needed to read binary file ' + filename)
+    if nrec is None:
+        nrec = data.size // nsamples
+    if nsamples is None:
+        nsamples = data.size // nrec
+
+    if nrec * nsamples != data.size:
+        raise ValueError('Invalid size of binary file %s: %d values for %d receivers with %d samples'
+                         % (filename, data.size, nrec, nsamples))
+
+    return data.reshape(nrec, nsamples)
+
+
+def read_su_seismograms(filename, nsamples=None):
+    """
+    reads in a Seismic Unix file U*_file_single.su
+
+    the number of samples is taken from the first trace header, unless given
+    (the header field is only 16 bits wide);
+    returns a read-only memory-mapped array (traces x samples), the time step size
+    (None if not stored in the header) and a dictionary with the header values
+    receiver, offset, xs, zs, xr, zr of all traces
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(SU_HEADER_SIZE)
+    if len(header) < SU_HEADER_SIZE:
+        raise ValueError('Invalid SU file ' + filename)
+
+    # number of samples and time step (in micro-seconds) as 16-bit integers
+    ns, dt_us = np.frombuffer(header[114:118], dtype=np.int16)
+    if nsamples is None:
+        nsamples = int(ns)
+    if dt_us > 0:
+        dt = dt_us * 1.e-6
+    else:
+        dt = None
+
+    raw = np.memmap(filename, dtype=np.float32, mode='r')
+    record_length = SU_HEADER_SIZE // 4 + nsamples
+    if nsamples <= 0 or raw.size % record_length != 0:
+        raise ValueError('Invalid size of SU file %s for %d samples per trace' % (filename, nsamples))
+    raw = raw.reshape(raw.size // record_length, record_length)
+
+    # integer header values
+    header_values = raw[:, 0:28].view(np.int32)
+    header = {'receiver': header_values[:, 0],
+              'offset': header_values[:, 9],
+              'xs': header_values[:, 18],
+              'zs': header_values[:, 19],
+              'xr': header_values[:, 20],
+              'zr': header_values[:, 21]}
+
+    return raw[:, SU_HEADER_SIZE // 4:], dt, header
+
+
+def read_seismograms(filename, nrec=None, nsamples=None, dt=None):
+    """
+    reads in a file of seismograms in any of the supported formats
+
+    for binary files, the number of receivers and the time step size are taken from the
+    STATIONS file and the Par_file next to the seismograms (or in DATA/), unless given;
+    returns the seismograms as 2D array (traces x samples) and the time step size
+    (None if unknown)
+    """
+    directory = os.path.dirname(filename)
+
+    if is_su_file(filename):
+        data, dt_su, header = read_su_seismograms(filename, nsamples)
+        if dt is None: dt = dt_su
+        return data, dt
+
+    if is_binary_file(filename):
+        if dt is None or (nrec is None and nsamples is None):
+            par_file = locate_data_file(directory, 'Par_file')
+            if par_file is not None:
+                dt_par, nsamples_par = read_seismogram_sampling(par_file)
+                if dt is None: dt = dt_par
+                if nrec is None and nsamples is None: nsamples = nsamples_par
+        if nrec is None and nsamples is None:
+            stations_file = locate_data_file(directory, 'STATIONS')
+            if stations_file is not None:
+                nrec = len(read_stations(stations_file)[0])
+        return read_binary_seismograms(filename, nrec, nsamples), dt
+
+    # ASCII file with a single trace
+    time, data = read_ascii_seismogram(filename)
+    if dt is None and len(time) > 1: dt = time[1] - time[0]
+    return data.reshape(1, len(data)), dt
+
+
+def file_signature(filename):
+    """
+    returns size and modification time of a file, used to validate cache entries
+    """
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime
+
+
+def get_cache_file(cache_dir, directory):
+    """
+    returns the name of the cache file for a seismogram directory (keyed by its absolute path)
+    """
+    key = hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'seismograms_' + key + '.npz')
+
+
+def load_cached_seismograms(cache_dir, directory):
+    """
+    loads the cached ASCII seismograms of a directory
+
+    returns a dictionary file name -> (time, amplitude) with all entries still matching
+    size and modification time of the files; outdated entries are skipped,
+    a missing or unreadable cache file gives an empty dictionary
+    """
+    cache_file = get_cache_file(cache_dir, directory)
+    if not os.path.isfile(cache_file): return {}
+
+    try:
+        with np.load(cache_file) as cache:
+            names = cache['names']
+            sizes = cache['sizes']
+            mtimes = cache['mtimes']
+            offsets = cache['offsets']
+            times = cache['times']
+            data = cache['data']
+    except Exception:
+        # broken cache file, gets rewritten
+        return {}
+
+    seismograms = {}
+    for i, name in enumerate(names):
+        name = str(name)
+        filename = os.path.join(directory, name)
+        if not os.path.isfile(filename): continue
+        if file_signature(filename) != (sizes[i], mtimes[i]): continue
+        seismograms[name] = (times[offsets[i]:offsets[i+1]], data[offsets[i]:offsets[i+1]])
+
+    # marks cache file as recently used (for eviction)
+    try:
+        os.utime(cache_file, None)
+    except OSError:
+        pass
+
+    return seismograms
+
+
+def save_cached_seismograms(cache_dir, directory, entries, max_size=CACHE_MAX_SIZE):
+    """
+    stores parsed ASCII seismograms of a directory in the cache
+
+    entries is a dictionary file name -> (signature, time, amplitude), with the file signature
+    taken before reading the file; replaces the previous cache file of the directory and
+    evicts least recently used cache files if the cache grows beyond max_size bytes
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    names = sorted(entries)
+    sizes = np.array([entries[name][0][0] for name in names], dtype=np.int64)
+    mtimes = np.array([entries[name][0][1] for name in names], dtype=np.float64)
+    lengths = [len(entries[name][2]) for name in names]
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+
+    times = np.empty(offsets[-1])
+    data = np.empty(offsets[-1])
+    for i, name in enumerate(names):
+        times[offsets[i]:offsets[i+1]] = entries[name][1]
+        data[offsets[i]:offsets[i+1]] = entries[name][2]
+
+    # writes to temporary file first, such that concurrent runs never read a partial file
+    cache_file = get_cache_file(cache_dir, directory)
+    tmp_file = cache_file + '.%d.tmp' % os.getpid()
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, names=np.array(names, dtype=np.unicode_), sizes=sizes, mtimes=mtimes,
+                 offsets=offsets, times=times, data=data)
+    os.rename(tmp_file, cache_file)
+
+    evict_cache(cache_dir, max_size, keep=cache_file)
+
+
+def evict_cache(cache_dir, max_size=CACHE_MAX_SIZE, keep=None):
+    """
+    removes least recently used cache files until the cache is smaller than max_size bytes
+
+    the file keep (e.g. the one just written) is never removed
+    """
+    files = []
+    for f in glob.glob(os.path.join(cache_dir, 'seismograms_*.npz')):
+        try:
+            st = os.stat(f)
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, f))
+
+    total = sum(size for mtime, size, f in files)
+    for mtime, size, f in sorted(files):
+        if total <= max_size: break
+        if keep is not None and os.path.abspath(f) == os.path.abspath(keep): continue
+        try:
+            os.remove(f)
+        except OSError:
+            continue
+        total -= size
+
+
+def zero_pad(t, ft, nzeros):
+    """
+    appends nzeros samples to the time array t and zeros to the signal ft
+
+    the time step must be constant, t[1]-t[0] = t[2]-t[1] = ...;
+    ft can also hold several signals (... x samples), which get padded along their last axis.
+    the padded arrays are allocated in one go (note that np.fft.rfft(ft, n) pads implicitly,
+    padding is only needed if the padded signal itself is used)
+    """
+    nzeros = max(int(nzeros), 0)
+    nt = len(t)
+
+    dt = t[1] - t[0]
+    t_pad = np.empty(nt + nzeros, dtype=np.result_type(t, np.float64))
+    t_pad[0:nt] = t
+    t_pad[nt:] = t[-1] + dt * np.arange(1, nzeros + 1)
+
+    ft = np.asarray(ft)
+    ft_pad = np.zeros(ft.shape[:-1] + (ft.shape[-1] + nzeros,), dtype=np.result_type(ft, np.float64))
+    ft_pad[..., 0:ft.shape[-1]] = ft
+
+    return t_pad, ft_pad